@@ -0,0 +1,81 @@
+"""
+Compare cohort table backends: a round trip per cell (as bitmapist did
+before), BITOP AND in a single pipeline ("redis" backend), the same in 4
+threads, and NumPy ("numpy" backend).
+
+Usage:
+
+    python benchmarks/bench_cohort.py [redis://localhost:6379/15]
+
+The benchmark deletes all bitmapist keys in the database it runs against.
+"""
+from __future__ import print_function
+
+import datetime
+import random
+import sys
+import time
+
+import bitmapist4
+from bitmapist4 import bits
+from bitmapist4.cohort import get_cohort_table
+
+USERS = 1000000
+WEEKS = 20
+SIGNUPS_PER_WEEK = 20000
+ACTIVE_PER_WEEK = 200000
+
+
+def per_cell(cohort, activity, rows):
+    """
+    Cell-at-a-time computation, used by bitmapist before
+    """
+    now = datetime.datetime.utcnow()
+    for cohort_offset in range(rows):
+        cohort_row = cohort.delta(-cohort_offset)
+        len(cohort_row)
+        for activity_offset in range(rows):
+            current = activity.delta(-cohort_offset + activity_offset)
+            if current.period_start() >= now:
+                break
+            len(cohort_row & current)
+
+
+def main(url='redis://localhost:6379/15'):
+    b = bitmapist4.Bitmapist(url, key_prefix='bench_')
+    b.delete_all_events()
+    now = datetime.datetime.utcnow()
+    events = []
+    for week in range(WEEKS):
+        timestamp = now - datetime.timedelta(weeks=week)
+        events.extend(('registered', random.randrange(USERS), timestamp)
+                      for _ in range(SIGNUPS_PER_WEEK))
+        events.extend(('active', random.randrange(USERS), timestamp)
+                      for _ in range(ACTIVE_PER_WEEK))
+    b.mark_events(events)
+
+    cohort, activity = b.WeekEvents('registered'), b.WeekEvents('active')
+    runs = [
+        ('per cell', lambda: per_cell(cohort, activity, WEEKS)),
+        ('redis', lambda: get_cohort_table(cohort, activity, WEEKS)),
+        ('redis x4', lambda: get_cohort_table(
+            cohort, activity, WEEKS, workers=4)),
+    ]
+    if bits.np is not None:
+        runs.append(('numpy', lambda: get_cohort_table(
+            cohort, activity, WEEKS, backend='numpy')))
+        runs.append(('numpy x4', lambda: get_cohort_table(
+            cohort, activity, WEEKS, backend='numpy', workers=4)))
+
+    for name, run in runs:
+        # temporary keys would make subsequent runs faster
+        b.delete_temporary_bitop_keys()
+        start = time.time()
+        run()
+        print('{:<10} {:>8.3f}s'.format(name, time.time() - start))
+
+    b.delete_all_events()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,61 @@
+"""
+Compare bitmap decoding engines, used by `get_uuids()`, on dense and
+sparse bitmaps.
+
+Usage:
+
+    python benchmarks/bench_get_uuids.py
+
+No Redis server is needed.
+"""
+from __future__ import print_function
+
+import random
+import time
+
+from bitmapist4 import bits
+
+SIZE = 1024 * 1024  # 8M bits
+
+
+def bytewise(data):
+    """
+    Byte-at-a-time decoder used by bitmapist before
+    """
+    for char_num, char in enumerate(bytearray(data)):
+        if char == 0:
+            continue
+        bits = [(char >> i) & 1 for i in range(7, -1, -1)]
+        set_bits = list(pos for pos, val in enumerate(bits) if val)
+        for bit in set_bits:
+            yield char_num * 8 + bit
+
+
+def make_bitmap(density):
+    data = bytearray(SIZE)
+    for _ in range(int(SIZE * 8 * density)):
+        position = random.randrange(SIZE * 8)
+        data[position // 8] |= 0x80 >> (position % 8)
+    return bytes(data)
+
+
+def main():
+    engines = [
+        ('bytewise', bytewise),
+        ('words', lambda data: bits._iter_set_bits_words(data, 0)),
+    ]
+    if bits.np is not None:
+        engines.append(('numpy', lambda data: bits._iter_set_bits_numpy(
+            data, 0)))
+
+    for name, density in [('dense', 0.5), ('sparse', 0.001)]:
+        data = make_bitmap(density)
+        for engine_name, engine in engines:
+            start = time.time()
+            count = sum(1 for _ in engine(data))
+            print('{:<7} {:<9} {:>8.3f}s ({} uuids)'.format(
+                name, engine_name, time.time() - start, count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""
+Compare the throughput of a `mark_event()` loop with `mark_events()`.
+
+Usage:
+
+    python benchmarks/bench_mark_events.py [redis://localhost:6379/15]
+
+The benchmark deletes all bitmapist keys in the database it runs against.
+"""
+from __future__ import print_function
+
+import random
+import sys
+import time
+
+import bitmapist4
+
+EVENTS = 50000
+USERS = 100000
+
+
+def main(url='redis://localhost:6379/15'):
+    b = bitmapist4.Bitmapist(url, key_prefix='bench_')
+    events = [('active', random.randrange(USERS), None)
+              for _ in range(EVENTS)]
+
+    b.delete_all_events()
+    start = time.time()
+    for event_name, uuid, timestamp in events:
+        b.mark_event(event_name, uuid, timestamp)
+    report('mark_event() loop', time.time() - start)
+
+    b.delete_all_events()
+    start = time.time()
+    b.mark_events(events)
+    report('mark_events()', time.time() - start)
+
+    b.delete_all_events()
+
+
+def report(name, elapsed):
+    print('{:<20} {:>8.3f}s {:>10.0f} events/s'.format(
+        name, elapsed, EVENTS / elapsed))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,35 @@
+"""
+Measure the cost of key computation in `Bitmapist._mark()` with and without
+memoization of key names.
+
+Usage:
+
+    python benchmarks/bench_mark_keys.py
+
+No Redis server is needed.
+"""
+from __future__ import print_function
+
+import datetime
+import timeit
+
+import bitmapist4
+
+CALLS = 100000
+
+
+def main():
+    now = datetime.datetime.utcnow()
+    cached = bitmapist4.Bitmapist('redis://', track_hourly=True)
+    uncached = bitmapist4.Bitmapist(
+        'redis://', track_hourly=True, key_cache_size=0)
+
+    for name, b in [('without cache', uncached), ('with cache', cached)]:
+        elapsed = timeit.timeit(
+            lambda: b._mark_keys('active', now, None, None), number=CALLS)
+        print('{:<15} {:>8.3f}s {:>8.2f}us per call'.format(
+            name, elapsed, elapsed * 1e6 / CALLS))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,540 @@
+"""
+Asyncio version of bitmapist, built on top of `redis.asyncio` (requires
+Python 3.7+ and redis-py 4.2+).
+
+AsyncBitmapist exposes the same event classes as Bitmapist, but every
+method talking to Redis is a coroutine. Buffering, bit-sliced indexes
+(`frequency()`) and `use_scripting` aren't supported, and raise errors.
+
+    from bitmapist4.aio import AsyncBitmapist
+
+    b = AsyncBitmapist('redis://localhost')
+    await b.mark_event('active', 123)
+
+    ev = b.WeekEvents('active')
+    count = await ev.get_count()
+    is_active = await ev.contains(123)
+    async for uuid in ev:
+        print(uuid)
+
+Bit operations don't touch Redis when they are created. They are executed
+on first access, or when awaited explicitly:
+
+    active_2_weeks = await (ev & ev.prev())
+
+All bit operations, needed for an event, are planned as with Bitmapist
+(see `bitmapist4.planner`) and sent in a single pipeline.
+
+Independent queries can run concurrently over the connection pool:
+
+    counts = await asyncio.gather(*[e.get_count() for e in events])
+"""
+import asyncio
+import datetime
+from contextlib import asynccontextmanager
+
+import redis.asyncio as aioredis
+
+from bitmapist4 import events as ev
+from bitmapist4 import planner
+from bitmapist4.bits import get_bits, iter_set_bits
+from bitmapist4.cache import CountCache
+from bitmapist4.core import Bitmapist
+from bitmapist4.scripts import MARK_SCRIPT
+
+
+class AsyncEventsMixin(object):
+    """
+    Async replacements of the BaseEvents methods, talking to Redis
+    """
+
+    async def materialize(self):
+        return self
+
+    def __await__(self):
+        return self.materialize().__await__()
+
+    async def has_events_marked(self):
+        await self.materialize()
+        return bool(await self.bitmapist.connection.exists(self.redis_key))
+
+    async def delete(self):
+        await self.bitmapist.connection.delete(self.redis_key)
+
+    async def get_uuids(self, chunk_size=None):
+        await self.materialize()
+        if chunk_size is None:
+            chunk_size = self.bitmapist.read_chunk_size
+        if chunk_size is not None and await self.bitmapist._server_supports(
+                'getrange', 'GETRANGE', self.bitmapist._probe_key(), 0, 0):
+            async for uuid in self._stream_uuids(0, chunk_size):
+                yield uuid
+            return
+
+        val = await self.bitmapist.connection.get(self.redis_key)
+        if val is None:
+            return
+        for uuid in iter_set_bits(val):
+            yield uuid
+
+    def __aiter__(self):
+        return self.get_uuids()
+
+    def __iter__(self):
+        raise TypeError('Use "async for" to iterate over async events')
+
+    async def _stream_uuids(self, start, chunk_size):
+        conn = self.bitmapist.connection
+        use_bitpos = await self.bitmapist._server_supports(
+            'bitpos', 'BITPOS', self.bitmapist._probe_key(), 1)
+        byte = start // 8
+        while True:
+            if use_bitpos:
+                byte = self._skip_to(
+                    byte, await conn.bitpos(self.redis_key, 1, byte))
+                if byte is None:
+                    return
+            data = await conn.getrange(self.redis_key, byte,
+                                       byte + chunk_size - 1)
+            for uuid in self._window_uuids(data, byte, start):
+                yield uuid
+            if len(data) < chunk_size:
+                return
+            byte += chunk_size
+
+    async def page(self, after_uuid=None, limit=100):
+        await self.materialize()
+        start, chunk_size = self._page_window(after_uuid, limit)
+        if await self.bitmapist._server_supports(
+                'getrange', 'GETRANGE', self.bitmapist._probe_key(), 0, 0):
+            uuids = self._stream_uuids(start, chunk_size)
+        else:
+            uuids = (uuid async for uuid in self.get_uuids() if uuid >= start)
+        page = []
+        async for uuid in uuids:
+            page.append(uuid)
+            if len(page) == limit:
+                break
+        await uuids.aclose()
+        return self._page_result(page, limit)
+
+    async def get_count(self):
+        await self.materialize()
+        return await self.bitmapist.connection.bitcount(self.redis_key)
+
+    def __len__(self):
+        raise TypeError('Use "await ev.get_count()" with async events')
+
+    async def contains(self, uuid):
+        await self.materialize()
+        return bool(await self.bitmapist.connection.getbit(
+            self.redis_key, uuid))
+
+    def __contains__(self, uuid):
+        raise TypeError('Use "await ev.contains(uuid)" with async events')
+
+    async def contains_many(self, uuids, batch_size=10000,
+                            fetch_threshold=50000):
+        await self.materialize()
+        uuids = list(uuids)
+        conn = self.bitmapist.connection
+        if len(uuids) >= fetch_threshold:
+            return get_bits(await conn.get(self.redis_key) or b'', uuids)
+
+        use_bitfield = await self.bitmapist._server_supports(
+            'bitfield', 'BITFIELD', self.bitmapist._probe_key(), 'GET', 'u1',
+            0)
+        ret = []
+        for start in range(0, len(uuids), batch_size):
+            chunk = uuids[start:start + batch_size]
+            if use_bitfield:
+                bits = await conn.execute_command(
+                    'BITFIELD', self.redis_key,
+                    *self.bitmapist._bitfield_args('GET', chunk))
+            else:
+                pipe = conn.pipeline()
+                for uuid in chunk:
+                    pipe.getbit(self.redis_key, uuid)
+                bits = await pipe.execute()
+            ret.extend(bool(bit) for bit in bits)
+        return ret
+
+
+class AsyncDerivedEventsMixin(AsyncEventsMixin):
+    async def materialize(self):
+        await self.parts_op.materialize()
+        return self
+
+
+class AsyncBitOperationMixin(AsyncEventsMixin):
+
+    async def materialize(self):
+        if not self.materialized:
+            await self.bitmapist.materialize([self])
+        return self
+
+
+class AsyncCountCache(CountCache):
+    """
+    Async version of the count cache
+    """
+
+    async def use_redis(self):
+        return await self.bitmapist._server_supports(
+            'hash', 'HLEN', self.bitmapist._probe_key())
+
+    async def get_many(self, event_keys):
+        if not event_keys:
+            return {}
+        if not await self.use_redis():
+            return self._get_local(event_keys)
+        return self._parse_counts(
+            event_keys, await self.bitmapist.connection.hmget(
+                self.redis_key, event_keys))
+
+    async def set_many(self, counts):
+        if not counts:
+            return
+        if not await self.use_redis():
+            self._set_local(counts)
+            return
+        await self.bitmapist.connection.execute_command(
+            'HSET', self.redis_key, *self._hset_args(counts))
+
+    async def invalidate(self, pipe, event_keys):
+        if not event_keys:
+            return
+        if not await self.use_redis():
+            self._delete_local(event_keys)
+            return
+        pipe.execute_command('HDEL', self.redis_key, *event_keys)
+
+    async def clear(self):
+        self.local.clear()
+        if await self.use_redis():
+            await self.bitmapist.connection.delete(self.redis_key)
+
+
+class AsyncBitmapist(Bitmapist):
+    """
+    Asyncio version of the core bitmapist object
+    """
+
+    def __init__(self, connection_or_url=None, **kwargs):
+        if kwargs.get('use_scripting'):
+            raise TypeError('AsyncBitmapist does not support use_scripting')
+        if connection_or_url is None:
+            connection_or_url = aioredis.StrictRedis()
+        super(AsyncBitmapist, self).__init__(connection_or_url, **kwargs)
+        self.count_cache = AsyncCountCache(self)
+
+    def _connect(self, connection_or_url):
+        if isinstance(connection_or_url, aioredis.StrictRedis):
+            return connection_or_url
+        return aioredis.StrictRedis.from_url(connection_or_url)
+
+    def _bind(self, event_class):
+        if issubclass(event_class, ev.BitOperation):
+            mixin = AsyncBitOperationMixin
+        elif issubclass(event_class, ev.DerivedEvents):
+            mixin = AsyncDerivedEventsMixin
+        else:
+            mixin = AsyncEventsMixin
+        return type(event_class.__name__, (mixin, event_class),
+                    {'bitmapist': self})
+
+    async def mark_event(self,
+                         event_name,
+                         uuid,
+                         timestamp=None,
+                         track_hourly=None,
+                         track_unique=None):
+        await self._mark(event_name, uuid, timestamp, 1, track_hourly,
+                         track_unique)
+
+    async def unmark_event(self,
+                           event_name,
+                           uuid,
+                           timestamp=None,
+                           track_hourly=None,
+                           track_unique=None):
+        await self._mark(event_name, uuid, timestamp, 0, track_hourly,
+                         track_unique)
+
+    async def _mark(self, event_name, uuid, timestamp, value, track_hourly,
+                    track_unique):
+        if timestamp is None:
+            timestamp = datetime.datetime.utcnow()
+
+        if self.pipe is None:
+            pipe = self.connection.pipeline()
+        else:
+            pipe = self.pipe
+
+        for redis_key in self._mark_keys(event_name, timestamp, track_hourly,
+                                         track_unique):
+            pipe.setbit(redis_key, uuid, value)
+        now = datetime.datetime.utcnow()
+        if self._late_mark(timestamp, now):
+            await self.count_cache.invalidate(
+                pipe, self._mark_keys(event_name, timestamp, track_hourly,
+                                      track_unique))
+            stale_keys = self._stale_rollup_keys(event_name, timestamp, now)
+            if stale_keys:
+                pipe.delete(*stale_keys)
+        indexed = []
+        if event_name not in self._indexed_events:
+            indexed = await self._index_events(pipe, [event_name])
+
+        if self.pipe is None:
+            await pipe.execute()
+        self._remember_indexed(indexed)
+
+    async def _index_events(self, pipe, event_names):
+        if not await self._server_supports('zset', 'ZCARD',
+                                           self._probe_key()):
+            return []
+        pipe.execute_command('ZADD', self.meta_key('events'),
+                             *self._event_index_args(event_names))
+        return list(event_names)
+
+    async def mark_events(self,
+                          events,
+                          track_hourly=None,
+                          track_unique=None,
+                          batch_size=10000):
+        await self._mark_many(events, 1, track_hourly, track_unique,
+                              batch_size)
+
+    async def unmark_events(self,
+                            events,
+                            track_hourly=None,
+                            track_unique=None,
+                            batch_size=10000):
+        await self._mark_many(events, 0, track_hourly, track_unique,
+                              batch_size)
+
+    async def _mark_many(self, events, value, track_hourly, track_unique,
+                         batch_size):
+        for offsets, stale_keys, stale_counts, event_names in \
+                self._group_marks(events, track_hourly, track_unique,
+                                  batch_size):
+            await self._setbits(offsets, value, stale_keys, stale_counts,
+                                event_names)
+
+    async def _setbits(self, offsets, value, stale_keys=(), stale_counts=(),
+                       event_names=()):
+        if self.pipe is None:
+            pipe = self.connection.pipeline()
+        else:
+            pipe = self.pipe
+
+        self._queue_bits(
+            pipe, offsets, value, await self._server_supports(
+                'bitfield', 'BITFIELD', self._probe_key(), 'GET', 'u1', 0))
+        if stale_keys:
+            pipe.delete(*stale_keys)
+        await self.count_cache.invalidate(pipe, list(stale_counts))
+        indexed = []
+        if event_names:
+            indexed = await self._index_events(pipe, event_names)
+
+        if self.pipe is None:
+            await pipe.execute()
+        self._remember_indexed(indexed)
+
+    async def _server_supports(self, feature, *probe_command):
+        if feature not in self._capabilities:
+            try:
+                await self.connection.execute_command(*probe_command)
+            except aioredis.ResponseError:
+                self._capabilities[feature] = False
+            else:
+                self._capabilities[feature] = True
+        return self._capabilities[feature]
+
+    async def _scripting_supported(self):
+        return await self._server_supports('scripting', 'SCRIPT', 'LOAD',
+                                           MARK_SCRIPT)
+
+    async def materialize(self, events):
+        pipe = self.connection.pipeline() if self.pipe is None else self.pipe
+        steps = await self._queue_plan(pipe, events)
+        if self.pipe is None:
+            self._finish_plan(steps, await pipe.execute())
+        else:
+            self._finish_plan(steps, None)
+
+    async def _queue_plan(self, pipe, events):
+        steps = planner.plan(events)
+        use_script = await self._scripting_supported()
+        finished = [step for step in steps if step.op.event_finished()]
+        existing = set()
+        if finished and not use_script:
+            check = self.connection.pipeline()
+            for step in finished:
+                check.ttl(step.redis_key)
+            existing = {
+                step.redis_key
+                for step, ttl in zip(finished, await check.execute())
+                if self._is_finished_result(ttl)
+            }
+        self._queue_steps(pipe, steps, finished, existing, use_script)
+        return steps
+
+    async def get_counts(self, events, use_cache=False):
+        finished_keys = (self.count_cache.finished_keys(events)
+                         if use_cache else [])
+        counts = await self.count_cache.get_many(finished_keys)
+        missing = self._missing_counts(events, counts)
+        if missing:
+            pipe = self.connection.pipeline()
+            steps = await self._queue_plan(pipe, missing.values())
+            for redis_key in missing:
+                pipe.bitcount(redis_key)
+            results = self._finish_plan(steps, await pipe.execute())
+            fetched = dict(zip(missing, results))
+            counts.update(fetched)
+            await self.count_cache.set_many(
+                self.count_cache.select(fetched, finished_keys))
+        return [counts[event.redis_key] for event in events]
+
+    async def count_series(self, event_name, granularity, start, end=None):
+        periods = self._period_range(event_name, granularity, start, end)
+        counts = await self.get_counts(periods, use_cache=True)
+        return [(period.period_start(), count)
+                for period, count in zip(periods, counts)]
+
+    async def user_timeline(self, event_name, uuid, granularity, start,
+                            end=None):
+        periods = self._period_range(event_name, granularity, start, end)
+        pipe = self.connection.pipeline()
+        for period in periods:
+            pipe.getbit(period.redis_key, uuid)
+        return [bool(bit) for bit in await pipe.execute()]
+
+    async def backfill_rollups(self, start, end=None, event_names=None):
+        if not self.use_rollups:
+            raise RuntimeError('Rollups are disabled')
+        if event_names is None:
+            event_names = await self.get_event_names()
+        misses = self.bitop_cache_stats['misses']
+        await self.materialize(self._finished_rollups(start, end, event_names))
+        return self.bitop_cache_stats['misses'] - misses
+
+    def frequency(self, events):
+        raise TypeError(
+            'AsyncBitmapist does not support bit-sliced indexes')
+
+    def start_buffering(self, *args, **kwargs):
+        raise TypeError(
+            'AsyncBitmapist does not support buffering, use '
+            'mark_events() for bulk updates')
+
+    async def commit_transaction(self):
+        if self.pipe is None:
+            raise RuntimeError("Transaction not started")
+        pipe, self.pipe = self.pipe, None
+        await pipe.execute()
+        self._indexed_events.update(self._transaction_indexed)
+        self._transaction_indexed.clear()
+
+    @asynccontextmanager
+    async def transaction(self):
+        self.start_transaction()
+        try:
+            yield
+            await self.commit_transaction()
+        except:
+            self.rollback_transaction()
+            raise
+
+    async def mark_unique(self, event_name, uuid):
+        await self._mark_unique(event_name, uuid, value=1)
+
+    async def unmark_unique(self, event_name, uuid):
+        await self._mark_unique(event_name, uuid, value=0)
+
+    async def _mark_unique(self, event_name, uuid, value):
+        redis_key = self.UniqueEvents(event_name).redis_key
+        pipe = self.connection.pipeline() if self.pipe is None else self.pipe
+        pipe.setbit(redis_key, uuid, value)
+        indexed = []
+        if event_name not in self._indexed_events:
+            indexed = await self._index_events(pipe, [event_name])
+        if self.pipe is None:
+            await pipe.execute()
+        self._remember_indexed(indexed)
+
+    async def get_event_names(self, prefix='', batch=10000):
+        if (await self._server_supports('zset', 'ZCARD', self._probe_key())
+                and await self.connection.exists(
+                    self.meta_key('events_indexed'))):
+            index_key = self.meta_key('events')
+            min_name, max_name = self._event_index_range(prefix)
+            ret = []
+            while min_name is not None:
+                names = await self.connection.zrangebylex(
+                    index_key, min_name, max_name, start=0, num=batch)
+                min_name = self._read_event_index_page(names, batch, ret)
+            return ret
+        return await self._scan_event_names(prefix, batch)
+
+    async def _scan_event_names(self, prefix, batch):
+        ret = {
+            self._parse_event_name(key)
+            async for key in self.connection.scan_iter(
+                match=self._event_keys_pattern(prefix), count=batch)
+        }
+        ret.discard(None)
+        return sorted(ret)
+
+    async def rebuild_event_index(self, batch=10000):
+        if not await self._server_supports('zset', 'ZCARD',
+                                           self._probe_key()):
+            raise RuntimeError('Server does not support sorted sets')
+        event_names = await self._scan_event_names('', batch)
+        pipe = self.connection.pipeline()
+        self._queue_event_index(pipe, event_names, batch)
+        await pipe.execute()
+        self._indexed_events.update(event_names)
+        return len(event_names)
+
+    async def delete_all_events(self, batch_size=1000, pause=0,
+                                progress=None):
+        deleted = await self._delete_keys('{}*'.format(self.key_prefix),
+                                          batch_size, pause, progress)
+        self.count_cache.local.clear()
+        self._indexed_events.clear()
+        return deleted
+
+    async def delete_temporary_bitop_keys(self, batch_size=1000, pause=0,
+                                          progress=None):
+        return await self._delete_keys('{}bitop_*'.format(self.key_prefix),
+                                       batch_size, pause, progress)
+
+    async def _delete_keys(self, pattern, batch_size, pause, progress):
+        command = await self._delete_command()
+        deleted = 0
+        batch = []
+        async for key in self.connection.scan_iter(
+                match=pattern, count=batch_size):
+            batch.append(key)
+            if len(batch) < batch_size:
+                continue
+            deleted += await self.connection.execute_command(command, *batch)
+            batch = []
+            if progress is not None:
+                progress(deleted)
+            if pause:
+                await asyncio.sleep(pause)
+        if batch:
+            deleted += await self.connection.execute_command(command, *batch)
+            if progress is not None:
+                progress(deleted)
+        return deleted
+
+    async def _delete_command(self):
+        if await self._server_supports('unlink', 'UNLINK', self._probe_key()):
+            return 'UNLINK'
+        return 'DEL'
@@ -0,0 +1,103 @@
+"""
+Helpers decoding Redis bitmaps.
+
+Bit N of the bitmap is the N-th bit of the string, starting from the most
+significant bit of the first byte, like in SETBIT and GETBIT.
+
+When NumPy is available, bitmaps are decoded with vectorized operations.
+Otherwise, a pure Python implementation processes 64-bit words at a time.
+"""
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Bitmaps are decoded in chunks of that many bytes, to keep the memory
+# used for intermediate arrays bounded
+CHUNK_SIZE = 64 * 1024
+
+if np is not None:
+    # number of set bits of every byte value
+    POPCOUNT = np.array([bin(i).count('1') for i in range(256)],
+                        dtype=np.uint8)
+
+
+def iter_set_bits(data, offset=0):
+    """
+    Yield positions of all set bits of the bitmap `data` in ascending
+    order. The `offset` is added to every position, which is helpful to
+    decode a chunk of a larger bitmap.
+    """
+    if np is not None:
+        return _iter_set_bits_numpy(data, offset)
+    return _iter_set_bits_words(data, offset)
+
+
+def _iter_set_bits_numpy(data, offset):
+    arr = np.frombuffer(data, dtype=np.uint8)
+    for start in range(0, len(arr), CHUNK_SIZE):
+        chunk = arr[start:start + CHUNK_SIZE]
+        nonzero = np.flatnonzero(chunk)
+        if not nonzero.size:
+            continue
+        bits = np.unpackbits(chunk[nonzero]).reshape(-1, 8)
+        rows, cols = np.nonzero(bits)
+        positions = (nonzero[rows] + start) * 8 + cols + offset
+        for position in positions.tolist():
+            yield position
+
+
+def _iter_set_bits_words(data, offset):
+    data = bytes(data)
+    for start in range(0, len(data), CHUNK_SIZE):
+        chunk = data[start:start + CHUNK_SIZE]
+        tail = len(chunk) % 8
+        if tail:
+            chunk += b'\0' * (8 - tail)
+        words = struct.unpack('>%dQ' % (len(chunk) // 8), chunk)
+        for word_num, word in enumerate(words):
+            if not word:
+                continue
+            base = offset + (start // 8 + word_num) * 64 + 64
+            while word:
+                length = word.bit_length()
+                yield base - length
+                word ^= 1 << (length - 1)
+
+
+def get_bits(data, offsets):
+    """
+    Return the list of booleans, the values of bits of the bitmap `data` at
+    the given offsets. Bits past the end of the bitmap are zeros.
+    """
+    data = bytearray(data)
+    size = len(data)
+    return [
+        offset // 8 < size and bool(data[offset // 8] & (0x80 >> (offset % 8)))
+        for offset in offsets
+    ]
+
+
+def to_matrix(bitmaps):
+    """
+    Return the 2D NumPy array of bytes, one row per bitmap. Shorter bitmaps
+    are padded with zeros (Redis treats missing bytes as zeros too).
+    Requires NumPy.
+    """
+    size = max([len(data) for data in bitmaps] + [1])
+    matrix = np.zeros((len(bitmaps), size), dtype=np.uint8)
+    for row, data in enumerate(bitmaps):
+        matrix[row, :len(data)] = np.frombuffer(data, dtype=np.uint8)
+    return matrix
+
+
+def count_bits(matrix):
+    """
+    Return the array of numbers of set bits in every row of the 2D array
+    of bytes. Requires NumPy.
+    """
+    if hasattr(np, 'bitwise_count'):  # NumPy 2.0+
+        return np.bitwise_count(matrix).sum(axis=1, dtype=np.int64)
+    return POPCOUNT[matrix].sum(axis=1, dtype=np.int64)
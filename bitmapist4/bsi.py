@@ -0,0 +1,184 @@
+"""
+Bit-sliced index of event frequencies.
+
+The index counts, for every uuid, in how many of the given events (e.g.
+the last 30 days) the uuid is marked. Counts are stored as a stack of
+bitmaps ("bit planes"): the bit `uuid` of the plane `i` is the bit `i` of
+the count of `uuid`. Planes are computed on the server by a ripple-carry
+adder of BITOP XOR and AND, and threshold queries over them return
+ordinary event objects.
+
+    days = [b.DayEvents('active').delta(-i) for i in range(30)]
+    freq = b.frequency(days)
+    power_users = freq.at_least(10)
+    print(len(power_users))
+    print(len(freq.between(2, 5) & b.UniqueEvents('premium')))
+
+Like other bit operations, everything is lazy and runs in a single
+pipeline on first access.
+"""
+from collections import OrderedDict
+
+from bitmapist4 import events as ev
+
+
+class SliceOperation(ev.BitOperation):
+    """
+    Bit operation of the bit-sliced index. The adder builds deep
+    expressions, so keys of the operations are always digests.
+
+    Operations of the adder share operands heavily, so walking their tree
+    recursively takes exponential time. Instead, every operation keeps the
+    list of input events it depends on (`inputs`), and derives its state
+    and period from them.
+    """
+
+    def __init__(self, op_name, *events):
+        self.op_name = op_name
+        self.events = events
+        self.redis_key = self.bitmapist.bitop_key(
+            op_name, [event.redis_key for event in events], digest=True)
+        self.materialized = False
+        inputs = OrderedDict()
+        for event in events:
+            for input_event in getattr(event, 'inputs', [event]):
+                inputs.setdefault(input_event.redis_key, input_event)
+        self.inputs = list(inputs.values())
+
+    def event_finished(self):
+        return all(event.event_finished() for event in self.inputs)
+
+    def period_start(self):
+        return min(event.period_start() for event in self.inputs)
+
+    def period_end(self):
+        return min(event.period_end() for event in self.inputs)
+
+    def delta(self, value, _shifted=None):
+        # shifted operations by key, so that shared operands are shifted once
+        if _shifted is None:
+            _shifted = {}
+        if self.redis_key not in _shifted:
+            events = []
+            for event in self.events:
+                if isinstance(event, SliceOperation):
+                    events.append(event.delta(value, _shifted))
+                else:
+                    events.append(event.delta(value))
+            _shifted[self.redis_key] = self.__class__(self.op_name, *events)
+        return _shifted[self.redis_key]
+
+    def __repr__(self):
+        return '{0.__class__.__name__}({0.op_name!r}, {0.redis_key!r})'.format(
+            self)
+
+
+class BitSlicedIndex(object):
+    """
+    Per-uuid counts of `events`, stored as bit planes (least significant
+    first). Use `Bitmapist.frequency()` to create the index.
+    """
+
+    def __init__(self, bitmapist, events):
+        self.bitmapist = bitmapist
+        self.events = list(events)
+        if not self.events:
+            raise ValueError('Frequency index needs at least one event')
+        self.planes = self._add(self.events)
+        if len(self.events) == 1:
+            self.universe = self.events[0]
+        else:
+            self.universe = self.bitmapist.BitOpOr(*self.events)
+
+    def _op(self, op_name, *events):
+        return self.bitmapist.SliceOperation(op_name, *events)
+
+    def _add(self, events):
+        """
+        Return the bit planes of the sum of events. Every event is added
+        with a ripple-carry adder: the carry of the plane i is (Pi AND c),
+        and the plane itself becomes (Pi XOR c). After j events counts don't
+        exceed j, so the number of planes is j.bit_length().
+        """
+        planes = []
+        for count, event in enumerate(events, 1):
+            carry = event
+            for i, plane in enumerate(planes):
+                planes[i] = self._op('XOR', plane, carry)
+                carry = self._op('AND', plane, carry)
+            if count.bit_length() > len(planes):
+                planes.append(carry)
+        return planes
+
+    def at_least(self, n):
+        """
+        Return events with uuids, marked in at least `n` of the events
+        """
+        if n < 1:
+            raise ValueError('n must be positive')
+        if n > len(self.events):
+            return self._empty()
+        if n == 1:
+            return self.universe
+
+        # compare counts with n, starting from the most significant plane.
+        # eq holds uuids with the same higher bits as n, gt - with greater
+        gt, eq = None, self.universe
+        for i in reversed(range(len(self.planes))):
+            plane = self.planes[i]
+            if n >> i & 1:
+                eq = self._op('AND', eq, plane)
+            else:
+                eq_plane = self._op('AND', eq, plane)
+                gt = eq_plane if gt is None else self._op('OR', gt, eq_plane)
+                # eq AND NOT plane, without NOT, which sets the trailing bits
+                eq = self._op('XOR', eq, eq_plane)
+        if gt is None:
+            return eq
+        return self._op('OR', gt, eq)
+
+    def exactly(self, n):
+        """
+        Return events with uuids, marked in exactly `n` of the events
+        """
+        return self.between(n, n)
+
+    def between(self, low, high):
+        """
+        Return events with uuids, marked in `low` to `high` (inclusive) of
+        the events
+        """
+        if low > high:
+            raise ValueError('low must not be greater than high')
+        if high >= len(self.events):
+            return self.at_least(low)
+        return self._op('XOR', self.at_least(low), self.at_least(high + 1))
+
+    def histogram(self):
+        """
+        Return the list of numbers of uuids, marked in exactly 1, 2, ...
+        len(events) of the events. All counts are fetched in a single
+        pipeline.
+        """
+        return self.bitmapist.get_counts(
+            [self.exactly(n) for n in range(1, len(self.events) + 1)])
+
+    def get(self, uuid):
+        """
+        Return the number of events, where `uuid` is marked
+        """
+        self.bitmapist.materialize(self.planes)
+        pipe = self.bitmapist.connection.pipeline()
+        for plane in self.planes:
+            pipe.getbit(plane.redis_key, uuid)
+        return sum(bit << i for i, bit in enumerate(pipe.execute()))
+
+    def delta(self, value):
+        return self.__class__(self.bitmapist,
+                              [event.delta(value) for event in self.events])
+
+    def _empty(self):
+        return self._op('XOR', self.universe, self.universe)
+
+    def __repr__(self):
+        return '{0.__class__.__name__}({0.events!r})'.format(self)
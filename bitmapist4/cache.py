@@ -0,0 +1,161 @@
+"""
+Process-local caches
+"""
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread-safe mapping, holding up to `maxsize` recently used items
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                return default
+            self.data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+class CountCache(object):
+    """
+    Cache of counts of finished events, keyed by their Redis keys.
+
+    Counts are stored in the Redis hash, so that they're shared between
+    processes. If the server doesn't support hashes (like bitmapist-server),
+    counts are cached in process memory instead.
+
+    Counts of plain events (days, weeks, etc.) are invalidated when their
+    finished periods get marked. In process memory, they're invalidated
+    only in the process making the mark. Counts of derived events, bit
+    operations and cohort cells are never invalidated automatically. If
+    events of finished periods get modified, call `clear()`.
+    """
+
+    def __init__(self, bitmapist, local_size=100000):
+        self.bitmapist = bitmapist
+        self.local = LRUCache(local_size)
+
+    @property
+    def redis_key(self):
+        return self.bitmapist.meta_key('counts')
+
+    def use_redis(self):
+        return self.bitmapist._server_supports(
+            'hash', 'HLEN', self.bitmapist._probe_key())
+
+    def get_many(self, event_keys):
+        """
+        Return the dict with cached counts for the given event keys
+        """
+        if not event_keys:
+            return {}
+        if not self.use_redis():
+            return self._get_local(event_keys)
+        return self._parse_counts(
+            event_keys,
+            self.bitmapist.connection.hmget(self.redis_key, event_keys))
+
+    def set_many(self, counts):
+        if not counts:
+            return
+        if not self.use_redis():
+            self._set_local(counts)
+            return
+        self.bitmapist.connection.execute_command('HSET', self.redis_key,
+                                                  *self._hset_args(counts))
+
+    def invalidate(self, client, event_keys):
+        """
+        Send the command removing cached counts of the given event keys to
+        the client (a Redis connection or a pipeline)
+        """
+        if not event_keys:
+            return
+        if not self.use_redis():
+            self._delete_local(event_keys)
+            return
+        client.execute_command('HDEL', self.redis_key, *event_keys)
+
+    @staticmethod
+    def finished_keys(events):
+        """
+        Return the list of unique keys of finished events, whose counts
+        can be cached
+        """
+        return list(
+            OrderedDict.fromkeys(event.redis_key for event in events
+                                 if event.event_finished()))
+
+    @staticmethod
+    def select(counts, event_keys):
+        """
+        Return the dict with the counts of `event_keys`, found in `counts`
+        """
+        return {
+            event_key: counts[event_key]
+            for event_key in event_keys if event_key in counts
+        }
+
+    def _get_local(self, event_keys):
+        ret = {}
+        for event_key in event_keys:
+            count = self.local.get(event_key)
+            if count is not None:
+                ret[event_key] = count
+        return ret
+
+    def _set_local(self, counts):
+        for event_key, count in counts.items():
+            self.local.set(event_key, count)
+
+    def _delete_local(self, event_keys):
+        for event_key in event_keys:
+            self.local.delete(event_key)
+
+    def _parse_counts(self, event_keys, counts):
+        """
+        Return the dict with counts from the HMGET result
+        """
+        return {
+            event_key: int(count)
+            for event_key, count in zip(event_keys, counts)
+            if count is not None
+        }
+
+    def _hset_args(self, counts):
+        args = []
+        for event_key, count in counts.items():
+            args.extend((event_key, count))
+        return args
+
+    def clear(self):
+        self.local.clear()
+        if self.use_redis():
+            self.bitmapist.connection.delete(self.redis_key)
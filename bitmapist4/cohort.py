@@ -8,16 +8,33 @@ render it yourself to HTML, or export to Pandas dataframe with df() method.
 
 The dataframe can be further colorized (to be displayed in Jupyter notebooks)
 with stylize().
+
+Cells are computed on the Redis server with BITOP AND (the default "redis"
+backend), or in process with NumPy (the "numpy" backend), which fetches every
+distinct bitmap once and doesn't write temporary keys to Redis.
 """
 import datetime
+import itertools
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
 try:
     import pandas as pd
 except ImportError:
     pd = None
 
+from bitmapist4 import bits
+
 
-def get_cohort_table(cohort, activity, rows=20, cols=None, use_percent=True):
-    # type: ("bitmapist4.events.BaseEvents", "bitmapist4.events.BaseEvents", int, int, bool) -> "CohortTable"
+def get_cohort_table(cohort,
+                     activity,
+                     rows=20,
+                     cols=None,
+                     use_percent=True,
+                     backend='redis',
+                     use_cache=False,
+                     workers=1):
+    # type: ("bitmapist4.events.BaseEvents", "bitmapist4.events.BaseEvents", int, int, bool, str, bool, int) -> "CohortTable"
     """
     Return a cohort table for two provided arguments: cohort and activity.
 
@@ -47,39 +64,232 @@ def get_cohort_table(cohort, activity, rows=20, cols=None, use_percent=True):
     registered this week. Naturally, the last row will contain only one cell,
     the number of users that were registered this week AND were active this
     week as well.
+
+    With `backend='numpy'` the cells are computed in process with NumPy
+    instead of BITOP AND on the server.
+
+    With `use_cache`, sizes of finished cohorts and cells, where both cohort
+    and activity periods are finished, are stored in the count cache (see
+    `Bitmapist.count_cache`). Subsequent calls only compute the cells,
+    touching the periods which are still open.
+
+    With `workers` greater than 1, rows are split between that many threads.
+    With the "redis" backend, every thread sends its own pipeline over the
+    connection pool of the bitmapist object. With the "numpy" backend,
+    bitmaps are still fetched once, and threads only compute the cells.
     """
+    get_counts = _get_backend(backend)
     if cols is None:
         cols = rows
     cols = min(cols, rows)
-    table = CohortTable()
+    now = datetime.datetime.utcnow()
+    cohorts = []
+    cells = []
     for cohort_offset in range(rows):
         cohort_to_explore = cohort.delta(-cohort_offset)  # moving backward
         base_activity = activity.delta(-cohort_offset)  # moving backward
-        cohort_row = get_cohort_row(
-            cohort_to_explore, base_activity, cols, use_percent=use_percent)
-        table.rows.insert(0, cohort_row)
+        cohorts.append(cohort_to_explore)
+        cells.append(_get_cells(cohort_to_explore, base_activity, cols, now))
+
+    counts = get_counts(cohort.bitmapist, cohorts, cells, use_cache, workers)
+    table = CohortTable()
+    for cohort_to_explore, (cohort_size, cell_counts) in zip(cohorts, counts):
+        table.rows.insert(
+            0,
+            _make_row(cohort_to_explore, cohort_size, cell_counts,
+                      use_percent))
     return table
 
 
-def get_cohort_row(cohort, activity, cols, use_percent=True):
+def get_cohort_row(cohort,
+                   activity,
+                   cols,
+                   use_percent=True,
+                   backend='redis',
+                   use_cache=False):
+    get_counts = _get_backend(backend)
     now = datetime.datetime.utcnow()
+    cells = _get_cells(cohort, activity, cols, now)
+    [(cohort_size, cell_counts)] = get_counts(cohort.bitmapist, [cohort],
+                                              [cells], use_cache)
+    return _make_row(cohort, cohort_size, cell_counts, use_percent)
 
-    cohort_name = cohort.period_start().strftime('%d %b %Y')
-    cohort_size = len(cohort)
 
-    row = CohortRow(cohort_name, cohort_size)
+def _get_cells(cohort, activity, cols, now):
+    """
+    Return the list of activity events for the cells of the cohort row,
+    one for every period after the cohort, which has started.
+    """
+    cells = []
     for activity_offset in range(cols):
         current_activity = activity.delta(activity_offset)  # forward
         if current_activity.period_start() >= now:
             break
-        affected_users = cohort & current_activity
+        cells.append(current_activity)
+    return cells
+
+
+def _get_backend(backend):
+    if backend == 'redis':
+        return _get_counts_redis
+    if backend == 'numpy':
+        if bits.np is None:
+            raise RuntimeError('Please install numpy library')
+        return _get_counts_numpy
+    raise ValueError('Unknown backend: {!r}'.format(backend))
+
+
+def _map_rows(func, rows, workers):
+    """
+    Call `func()` with chunks of `rows` in a pool of `workers` threads, and
+    return the combined list of results, one per row. `func()` takes a list
+    of rows, and returns the list of results for them. Later rows contain
+    more cells, so rows are dealt to the chunks in turn to balance the load.
+    """
+    workers = min(workers, len(rows))
+    if workers <= 1:
+        return func(rows)
+    chunks = [list(range(start, len(rows), workers))
+              for start in range(workers)]
+
+    def run(chunk):
+        return func([rows[i] for i in chunk])
+
+    pool = ThreadPool(workers)
+    try:
+        results = pool.map(run, chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+    ret = [None] * len(rows)
+    for chunk, chunk_results in zip(chunks, results):
+        for i, result in zip(chunk, chunk_results):
+            ret[i] = result
+    return ret
+
+
+def _get_counts_redis(bitmapist, cohorts, cells, use_cache, workers=1):
+    """
+    Return the list of tuples (cohort size, list of cell counts), one for
+    every cohort. Cells are `cohort & activity` operations. All bit
+    operations and counts are executed at once in a single pipeline (see
+    `Bitmapist.get_counts()`), or a pipeline per thread with `workers`.
+    With `use_cache`, counts of finished cells and cohorts are taken from
+    the count cache.
+    """
+    if workers > 1:
+        return _map_rows(
+            lambda rows: _get_counts_redis(
+                bitmapist, [cohort for cohort, _ in rows],
+                [row_cells for _, row_cells in rows], use_cache),
+            list(zip(cohorts, cells)), workers)
+
+    events = list(cohorts)
+    for cohort, row_cells in zip(cohorts, cells):
+        events.extend(cohort & activity for activity in row_cells)
+    counts = bitmapist.get_counts(events, use_cache=use_cache)
+
+    ret = []
+    pos = len(cohorts)
+    for cohort_size, row_cells in zip(counts, cells):
+        ret.append((cohort_size, counts[pos:pos + len(row_cells)]))
+        pos += len(row_cells)
+    return ret
+
+
+def _get_counts_numpy(bitmapist, cohorts, cells, use_cache, workers=1):
+    """
+    Return the same as `_get_counts_redis()`, but compute the cells in
+    process: every distinct cohort and activity bitmap is fetched once
+    (in a single pipeline), and the sizes of intersections are computed
+    with vectorized AND and popcount, split between `workers` threads.
+
+    Counts are cached under the same keys as with the "redis" backend, so
+    that both backends share the count cache.
+    """
+    # bit operations are never executed, they define the keys of the cells
+    ops = [[cohort & activity for activity in row_cells]
+           for cohort, row_cells in zip(cohorts, cells)]
+    finished_keys = (bitmapist.count_cache.finished_keys(
+        itertools.chain(cohorts, *ops)) if use_cache else [])
+    counts = bitmapist.count_cache.get_many(finished_keys)
+
+    # bitmaps, needed to compute the missing counts
+    events = OrderedDict()
+    for cohort, row_ops in zip(cohorts, ops):
+        missing = [op for op in row_ops if op.redis_key not in counts]
+        if missing or cohort.redis_key not in counts:
+            events.setdefault(cohort.redis_key, cohort)
+        for op in missing:
+            activity = op.events[1]
+            events.setdefault(activity.redis_key, activity)
+
+    if events:
+        fetched = _fetch_counts_numpy(bitmapist, events, cohorts, ops, counts,
+                                      workers)
+        counts.update(fetched)
+        bitmapist.count_cache.set_many(
+            bitmapist.count_cache.select(fetched, finished_keys))
+    return [(counts[cohort.redis_key], [counts[op.redis_key] for op in row_ops])
+            for cohort, row_ops in zip(cohorts, ops)]
+
+
+def _fetch_counts_numpy(bitmapist, events, cohorts, ops, counts, workers):
+    """
+    Fetch bitmaps of `events` and return the dict with the counts of
+    cohorts and cells, missing from `counts`
+    """
+    pipe = bitmapist.connection.pipeline()
+    # years, ranges and other derived events need their bit operations
+    steps = bitmapist._queue_plan(pipe, events.values())
+    for redis_key in events:
+        pipe.get(redis_key)
+    bitmaps = bitmapist._finish_plan(steps, pipe.execute())
+    matrix = bits.to_matrix([data or b'' for data in bitmaps])
+    index = {redis_key: row for row, redis_key in enumerate(events)}
+
+    def count_rows(rows):
+        ret = []
+        for cohort, row_ops in rows:
+            row_counts = {}
+            ret.append(row_counts)
+            if cohort.redis_key not in index:
+                continue
+            cohort_bits = matrix[index[cohort.redis_key]]
+            if cohort.redis_key not in counts:
+                row_counts[cohort.redis_key] = int(
+                    bits.count_bits(cohort_bits[None, :])[0])
+            missing = [op for op in row_ops if op.redis_key not in counts]
+            if not missing:
+                continue
+            activity_bits = matrix[[
+                index[op.events[1].redis_key] for op in missing
+            ]]
+            cell_counts = bits.count_bits(activity_bits & cohort_bits).tolist()
+            row_counts.update(
+                (op.redis_key, count)
+                for op, count in zip(missing, cell_counts))
+        return ret
+
+    fetched = {}
+    for row_counts in _map_rows(count_rows, list(zip(cohorts, ops)),
+                                workers):
+        fetched.update(row_counts)
+    return fetched
+
+
+def _make_row(cohort, cohort_size, cell_counts, use_percent):
+    cohort_name = cohort.period_start().strftime('%d %b %Y')
+    row = CohortRow(cohort_name, cohort_size)
+    for affected_users in cell_counts:
         if use_percent:
             if cohort_size == 0:
                 _affected = 0
             else:
-                _affected = len(affected_users) * 100.0 / cohort_size
+                _affected = affected_users * 100.0 / cohort_size
         else:
-            _affected = len(affected_users)
+            _affected = affected_users
         row.cells.append(_affected)
     return row
 
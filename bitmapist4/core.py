@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from collections import defaultdict, OrderedDict
 from contextlib import contextmanager
 try:
     from typing import Type
@@ -6,8 +7,17 @@ except ImportError:  # Python 2.x
     pass
 
 import redis
+import calendar
 import datetime
+import hashlib
+import threading
+import time
+from bitmapist4 import bsi
 from bitmapist4 import events as ev
+from bitmapist4 import planner
+from bitmapist4.cache import CountCache, LRUCache
+from bitmapist4.scripts import BITOP_SCRIPT, MARK_SCRIPT
+from bitmapist4.writer import BufferedWriter
 
 
 class Bitmapist(object):
@@ -29,39 +39,73 @@ class Bitmapist(object):
                  track_unique=True,
                  finished_ops_expire=3600 * 24,
                  unfinished_ops_expire=60,
-                 key_prefix='bitmapist_'):
-        if isinstance(connection_or_url, redis.StrictRedis):
-            self.connection = connection_or_url
-        else:
-            self.connection = redis.StrictRedis.from_url(connection_or_url)
+                 key_prefix='bitmapist_',
+                 use_scripting=False,
+                 key_cache_size=1024,
+                 read_chunk_size=None,
+                 hash_bitop_keys=False,
+                 record_bitop_expressions=False,
+                 use_rollups=False):
+        self.connection = self._connect(connection_or_url)
         self.track_hourly = track_hourly
         self.track_unique = track_unique
         self.finished_ops_expire = finished_ops_expire
         self.unfinished_ops_expire = unfinished_ops_expire
         self.key_prefix = key_prefix
+        self.use_scripting = use_scripting
+        self.read_chunk_size = read_chunk_size
+        self.hash_bitop_keys = hash_bitop_keys
+        self.record_bitop_expressions = record_bitop_expressions
+        self.use_rollups = use_rollups
         self.pipe = None
+        self.writer = None
+        self._capabilities = {}
+        self._mark_script = self.connection.register_script(MARK_SCRIPT)
+        self.bitop_cache_stats = {'hits': 0, 'misses': 0}
+        # stats are updated from threads, sharing the object (e.g. by
+        # cohort tables with workers)
+        self._stats_lock = threading.Lock()
+        self._mark_keys_cache = LRUCache(key_cache_size)
+        # names of events, already added to the index by this process
+        self._indexed_events = set()
+        # names, added to the index by the current transaction
+        self._transaction_indexed = set()
+        self.count_cache = CountCache(self)
 
-        kw = {'bitmapist': self}
-        self.UniqueEvents = type('UniqueEvents', (ev.UniqueEvents, ),
-                                 kw)  # type: Type[ev.UniqueEvents]
-        self.YearEvents = type('YearEvents', (ev.YearEvents, ),
-                               kw)  # type: Type[ev.YearEvents]
-        self.MonthEvents = type('MonthEvents', (ev.MonthEvents, ),
-                                kw)  # type: Type[ev.MonthEvents]
-        self.WeekEvents = type('WeekEvents', (ev.WeekEvents, ),
-                               kw)  # type: Type[ev.WeekEvents]
-        self.DayEvents = type('DayEvents', (ev.DayEvents, ),
-                              kw)  # type: Type[ev.DayEvents]
-        self.HourEvents = type('HourEvents', (ev.HourEvents, ),
-                               kw)  # type: Type[ev.HourEvents]
-        self.BitOpAnd = type('BitOpAnd', (ev.BitOpAnd, ),
-                             kw)  # type: Type[ev.BitOpAnd]
-        self.BitOpOr = type('BitOpOr', (ev.BitOpOr, ),
-                            kw)  # type: Type[ev.BitOpOr]
-        self.BitOpXor = type('BitOpXor', (ev.BitOpXor, ),
-                             kw)  # type: Type[ev.BitOpXor]
-        self.BitOpNot = type('BitOpNot', (ev.BitOpNot, ),
-                             kw)  # type: Type[ev.BitOpNot]
+        self.UniqueEvents = self._bind(
+            ev.UniqueEvents)  # type: Type[ev.UniqueEvents]
+        self.YearEvents = self._bind(
+            ev.YearEvents)  # type: Type[ev.YearEvents]
+        self.QuarterEvents = self._bind(
+            ev.QuarterEvents)  # type: Type[ev.QuarterEvents]
+        self.MonthEvents = self._bind(
+            ev.MonthEvents)  # type: Type[ev.MonthEvents]
+        self.WeekEvents = self._bind(
+            ev.WeekEvents)  # type: Type[ev.WeekEvents]
+        self.DayEvents = self._bind(ev.DayEvents)  # type: Type[ev.DayEvents]
+        self.HourEvents = self._bind(
+            ev.HourEvents)  # type: Type[ev.HourEvents]
+        self.RangeEvents = self._bind(
+            ev.RangeEvents)  # type: Type[ev.RangeEvents]
+        self.BitOpAnd = self._bind(ev.BitOpAnd)  # type: Type[ev.BitOpAnd]
+        self.BitOpOr = self._bind(ev.BitOpOr)  # type: Type[ev.BitOpOr]
+        self.BitOpXor = self._bind(ev.BitOpXor)  # type: Type[ev.BitOpXor]
+        self.BitOpNot = self._bind(ev.BitOpNot)  # type: Type[ev.BitOpNot]
+        self.Rollup = self._bind(ev.Rollup)  # type: Type[ev.Rollup]
+        self.SliceOperation = self._bind(
+            bsi.SliceOperation)  # type: Type[bsi.SliceOperation]
+
+    def _connect(self, connection_or_url):
+        if isinstance(connection_or_url, redis.StrictRedis):
+            return connection_or_url
+        return redis.StrictRedis.from_url(connection_or_url)
+
+    def _bind(self, event_class):
+        """
+        Return a subclass of `event_class` bound to this bitmapist object
+        """
+        return type(event_class.__name__, (event_class, ),
+                    {'bitmapist': self})
 
     def mark_event(self,
                    event_name,
@@ -107,43 +151,362 @@ class Bitmapist(object):
               track_unique):
         if timestamp is None:
             timestamp = datetime.datetime.utcnow()
+
+        if self.pipe is not None:
+            # marks of a transaction aren't buffered, so that they're
+            # executed (or discarded) with the transaction
+            self._remember_indexed(
+                self._queue_mark(self.pipe, event_name, uuid, timestamp,
+                                 value, track_hourly, track_unique))
+        elif self.writer is not None:
+            self.writer.put((event_name, uuid, timestamp, value, track_hourly,
+                             track_unique))
+        elif (self.use_scripting and self._scripting_supported()
+              and event_name in self._indexed_events
+              and not self._late_mark(timestamp)):
+            # a single EVALSHA, no need to wrap it with a pipeline. Marks,
+            # which also invalidate cached counts and rollups or index the
+            # event, are sent in a pipeline to stay atomic
+            self._queue_mark(self.connection, event_name, uuid, timestamp,
+                             value, track_hourly, track_unique)
+        else:
+            pipe = self.connection.pipeline()
+            indexed = self._queue_mark(pipe, event_name, uuid, timestamp,
+                                       value, track_hourly, track_unique)
+            pipe.execute()
+            self._remember_indexed(indexed)
+
+    def _queue_mark(self, client, event_name, uuid, timestamp, value,
+                    track_hourly, track_unique):
+        """
+        Send commands marking the event to the client (a Redis connection
+        or a pipeline). Return the list of event names, added to the index,
+        to pass to `_remember_indexed()` once the commands are executed.
+        """
+        if self.use_scripting and self._scripting_supported():
+            self._mark_with_script(client, event_name, uuid, timestamp, value,
+                                   track_hourly, track_unique)
+        else:
+            for redis_key in self._mark_keys(event_name, timestamp,
+                                             track_hourly, track_unique):
+                client.setbit(redis_key, uuid, value)
+
+        now = datetime.datetime.utcnow()
+        if self._late_mark(timestamp, now):
+            self.count_cache.invalidate(
+                client, self._mark_keys(event_name, timestamp, track_hourly,
+                                        track_unique))
+            stale_keys = self._stale_rollup_keys(event_name, timestamp, now)
+            if stale_keys:
+                client.delete(*stale_keys)
+        if event_name not in self._indexed_events:
+            return self._index_events(client, [event_name])
+        return []
+
+    def _late_mark(self, timestamp, now=None):
+        """
+        Return True if the mark at the moment `timestamp` modifies finished
+        periods (it's made before the current hour), so that their cached
+        counts and rollups become stale
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+        return timestamp < now.replace(minute=0, second=0, microsecond=0)
+
+    def _index_events(self, client, event_names):
+        """
+        Send the command adding event names to the index of events (a
+        sorted set with equal scores, ordered by name). Return the list of
+        sent names.
+
+        Every name is sent once per process: sent names are remembered with
+        `_remember_indexed()` after the command is executed, so that names
+        of failed commands are sent again.
+        """
+        if not self._server_supports('zset', 'ZCARD', self._probe_key()):
+            return []
+        client.execute_command('ZADD', self.meta_key('events'),
+                               *self._event_index_args(event_names))
+        return list(event_names)
+
+    def _remember_indexed(self, event_names):
+        """
+        Remember names, added to the index by executed commands. In a
+        transaction, names are remembered when it's committed.
+        """
+        if self.pipe is not None:
+            self._transaction_indexed.update(event_names)
+        else:
+            self._indexed_events.update(event_names)
+
+    def _event_index_args(self, event_names):
+        """
+        Return ZADD arguments, adding event names with the score 0
+        """
+        args = []
+        for name in event_names:
+            args.extend((0, name))
+        return args
+
+    def _stale_rollup_keys(self, event_name, timestamp, now=None):
+        """
+        Return the tuple of rollup keys, which become stale when the event
+        `event_name` is marked at the moment `timestamp`.
+
+        Rollups exist only for finished periods, so only late marks (the
+        ones made after the quarter or the year is over) invalidate them.
+        Keys are memoized per event name and quarter, like the keys of
+        `_mark_keys()`.
+        """
+        if not self.use_rollups:
+            return ()
+        if now is None:
+            now = datetime.datetime.utcnow()
+        quarter = (timestamp.month - 1) // 3 + 1
+        if (timestamp.year, quarter) >= (now.year, (now.month - 1) // 3 + 1):
+            return ()
+        year_finished = timestamp.year < now.year
+        bucket = ('rollups', event_name, timestamp.year, quarter,
+                  year_finished)
+        stale_keys = self._mark_keys_cache.get(bucket)
+        if stale_keys is None:
+            stale_keys = (self.prefix_key(
+                event_name, 'Q%s-%s' % (timestamp.year, quarter)), )
+            if year_finished:
+                stale_keys = (self.prefix_key(
+                    event_name, 'Y%s' % timestamp.year), ) + stale_keys
+            self._mark_keys_cache.set(bucket, stale_keys)
+        return stale_keys
+
+    def _scripting_supported(self):
+        """
+        Return True if the server supports Lua scripting (bitmapist-server
+        doesn't). The mark script is loaded to the server as a side effect.
+        """
+        return self._server_supports('scripting', 'SCRIPT', 'LOAD',
+                                     MARK_SCRIPT)
+
+    def _mark_with_script(self, client, event_name, uuid, timestamp, value,
+                          track_hourly, track_unique):
+        """
+        Mark the event with a single EVALSHA call. All the keys are derived
+        from the timestamp on the server side.
+        """
+        if track_hourly is None:
+            track_hourly = self.track_hourly
+        if track_unique is None:
+            track_unique = self.track_unique
+        self._mark_script(
+            args=[
+                self.key_prefix, event_name, uuid, value,
+                calendar.timegm(timestamp.timetuple()),
+                int(bool(track_hourly)),
+                int(bool(track_unique))
+            ],
+            client=client)
+
+    def _mark_keys(self, event_name, timestamp, track_hourly, track_unique):
+        """
+        Return the tuple of Redis keys to update when marking the event
+        `event_name` at the moment `timestamp`.
+
+        Keys are memoized per event name, hour and flags, so that hot events
+        don't compute the same key names over and over again.
+        """
         if track_hourly is None:
             track_hourly = self.track_hourly
         if track_unique is None:
             track_unique = self.track_unique
 
-        obj_classes = [self.MonthEvents, self.WeekEvents, self.DayEvents]
-        if track_hourly:
-            obj_classes.append(self.HourEvents)
-        if track_unique:
-            obj_classes.append(self.UniqueEvents)
+        bucket = (event_name, timestamp.year, timestamp.month, timestamp.day,
+                  timestamp.hour if track_hourly else None, track_unique)
+        redis_keys = self._mark_keys_cache.get(bucket)
+        if redis_keys is None:
+            obj_classes = [self.MonthEvents, self.WeekEvents, self.DayEvents]
+            if track_hourly:
+                obj_classes.append(self.HourEvents)
+            if track_unique:
+                obj_classes.append(self.UniqueEvents)
+            redis_keys = tuple(
+                obj_class.from_date(event_name, timestamp).redis_key
+                for obj_class in obj_classes)
+            self._mark_keys_cache.set(bucket, redis_keys)
+        return redis_keys
+
+    def mark_events(self,
+                    events,
+                    track_hourly=None,
+                    track_unique=None,
+                    batch_size=10000):
+        """
+        Marks many events as "happened" at once.
+
+        - events is an iterable of `(event_name, uuid, timestamp)` tuples.
+          Timestamp can be None, in which case the current moment is used
+        - batch_size is the maximum number of bits sent to the server in a
+          single pipeline
+
+        Keys are resolved once per event name and hour, and bits of the
+        same key are packed together in one BITFIELD command (or a series
+        of SETBIT commands, if the server doesn't support BITFIELD).
+
+        Example:
+
+            b.mark_events([
+                ('active', 1, None),
+                ('active', 2, None),
+                ('song:played', 1, datetime.datetime(2018, 1, 1)),
+            ])
+        """
+        self._mark_many(events, 1, track_hourly, track_unique, batch_size)
+
+    def unmark_events(self,
+                      events,
+                      track_hourly=None,
+                      track_unique=None,
+                      batch_size=10000):
+        """
+        Marks many events as "not happened" at once. Accepts the same
+        arguments as `mark_events()`.
+        """
+        self._mark_many(events, 0, track_hourly, track_unique, batch_size)
+
+    def _mark_many(self, events, value, track_hourly, track_unique,
+                   batch_size):
+        for offsets, stale_keys, stale_counts, event_names in \
+                self._group_marks(events, track_hourly, track_unique,
+                                  batch_size):
+            self._setbits(offsets, value, stale_keys, stale_counts,
+                          event_names)
 
+    def _group_marks(self, events, track_hourly, track_unique, batch_size):
+        """
+        Group events by Redis keys. Yield tuples (offsets, stale_keys,
+        stale_counts, event_names), where offsets is a mapping from keys to
+        the lists of bit offsets, containing up to `batch_size` offsets,
+        stale_keys is the set of rollup keys to delete after the bits are
+        set, stale_counts is the set of keys of finished periods, whose
+        cached counts are invalidated, and event_names is the set of names
+        to add to the index of events.
+        """
+        now = datetime.datetime.utcnow()
+        offsets = defaultdict(list)
+        stale_keys = set()
+        stale_counts = set()
+        event_names = set()
+        pending = 0
+        for event_name, uuid, timestamp in events:
+            if timestamp is None:
+                timestamp = now
+            redis_keys = self._mark_keys(event_name, timestamp, track_hourly,
+                                         track_unique)
+            for redis_key in redis_keys:
+                offsets[redis_key].append(uuid)
+            if self._late_mark(timestamp, now):
+                stale_counts.update(redis_keys)
+                stale_keys.update(
+                    self._stale_rollup_keys(event_name, timestamp, now))
+            if event_name not in self._indexed_events:
+                event_names.add(event_name)
+            pending += len(redis_keys)
+            if pending >= batch_size:
+                yield offsets, stale_keys, stale_counts, event_names
+                offsets = defaultdict(list)
+                stale_keys = set()
+                stale_counts = set()
+                event_names = set()
+                pending = 0
+        if offsets:
+            yield offsets, stale_keys, stale_counts, event_names
+
+    def _setbits(self, offsets, value, stale_keys=(), stale_counts=(),
+                 event_names=()):
+        """
+        Set bits in one pipeline. `offsets` is a mapping from Redis keys
+        to the lists of bit offsets to set to `value`. Rollup keys from
+        `stale_keys` are deleted, cached counts of `stale_counts` are
+        invalidated, and `event_names` are added to the index of events in
+        the same pipeline.
+        """
         if self.pipe is None:
             pipe = self.connection.pipeline()
         else:
             pipe = self.pipe
 
-        for obj_class in obj_classes:
-            pipe.setbit(
-                obj_class.from_date(event_name, timestamp).redis_key, uuid,
-                value)
+        self._queue_bits(
+            pipe, offsets, value,
+            self._server_supports('bitfield', 'BITFIELD', self._probe_key(),
+                                  'GET', 'u1', 0))
+        if stale_keys:
+            pipe.delete(*stale_keys)
+        self.count_cache.invalidate(pipe, list(stale_counts))
+        indexed = self._index_events(pipe, event_names) if event_names else []
 
         if self.pipe is None:
             pipe.execute()
+        self._remember_indexed(indexed)
+
+    def _queue_bits(self, pipe, offsets, value, use_bitfield):
+        """
+        Send commands setting bits of `offsets` to `value` to the pipeline,
+        with a BITFIELD command per key or with SETBIT commands
+        """
+        for redis_key, uuids in offsets.items():
+            if use_bitfield:
+                pipe.execute_command(
+                    'BITFIELD', redis_key,
+                    *self._bitfield_args('SET', uuids, value))
+            else:
+                for uuid in uuids:
+                    pipe.setbit(redis_key, uuid, value)
+
+    def _bitfield_args(self, subcommand, offsets, *value):
+        """
+        Return BITFIELD arguments, applying the GET or SET subcommand (with
+        the `value`) to single bits at `offsets`
+        """
+        args = []
+        for offset in offsets:
+            args.extend((subcommand, 'u1', offset) + value)
+        return args
+
+    def _server_supports(self, feature, *probe_command):
+        """
+        Return True if the server supports the feature. The support is
+        detected once by sending a probe command, and the result is cached.
+        Needed to stay compatible with bitmapist-server, which implements
+        only a subset of Redis commands.
+        """
+        if feature not in self._capabilities:
+            try:
+                self.connection.execute_command(*probe_command)
+            except redis.ResponseError:
+                self._capabilities[feature] = False
+            else:
+                self._capabilities[feature] = True
+        return self._capabilities[feature]
+
+    def _probe_key(self):
+        return '{}bitop_probe'.format(self.key_prefix)
 
     def start_transaction(self):
         if self.pipe is not None:
             raise RuntimeError("Transaction already started")
         self.pipe = self.connection.pipeline()
+        self._transaction_indexed.clear()
 
     def commit_transaction(self):
         if self.pipe is None:
             raise RuntimeError("Transaction not started")
         self.pipe.execute()
         self.pipe = None
+        self._indexed_events.update(self._transaction_indexed)
+        self._transaction_indexed.clear()
 
     def rollback_transaction(self):
         self.pipe = None
+        # names, indexed in the transaction, have to be sent again
+        self._transaction_indexed.clear()
 
     @contextmanager
     def transaction(self):
@@ -155,6 +518,57 @@ class Bitmapist(object):
             self.rollback_transaction()
             raise
 
+    def start_buffering(self,
+                        batch_size=1000,
+                        flush_interval=1.0,
+                        max_queue_size=100000,
+                        on_full='block'):
+        """
+        Switch `mark_event` and `unmark_event` to the buffered mode. Instead
+        of talking to Redis, the calls put events to an in-process queue,
+        and a background thread sends them to Redis in pipelines of up to
+        `batch_size` events, at least every `flush_interval` seconds.
+
+        - max_queue_size limits the number of events waiting in the queue
+        - on_full defines what to do when the queue is full: "block" waits
+          until there is a free slot, and "drop" discards the event
+
+        Buffered events are flushed on `flush()`, on `stop_buffering()`, and
+        on the interpreter exit. Events, marked in a transaction, aren't
+        buffered: they're sent with the transaction.
+
+        Example:
+
+            b.start_buffering(flush_interval=5)
+            b.mark_event('active', 123)  # returns immediately
+        """
+        if self.writer is not None:
+            raise RuntimeError("Buffering already started")
+        self.writer = BufferedWriter(
+            self,
+            batch_size=batch_size,
+            flush_interval=flush_interval,
+            max_queue_size=max_queue_size,
+            on_full=on_full)
+
+    def flush(self, timeout=None):
+        """
+        Wait until all buffered events are sent to Redis. Return False if
+        the timeout is over before events were sent.
+        """
+        if self.writer is None:
+            return True
+        return self.writer.flush(timeout)
+
+    def stop_buffering(self):
+        """
+        Flush buffered events and switch back to the unbuffered mode
+        """
+        if self.writer is None:
+            raise RuntimeError("Buffering not started")
+        writer, self.writer = self.writer, None
+        writer.close()
+
     def mark_unique(self, event_name, uuid):
         """
         Mark unique event as "happened with a user"
@@ -195,37 +609,482 @@ class Bitmapist(object):
         conn = self.connection if self.pipe is None else self.pipe
         redis_key = self.UniqueEvents(event_name).redis_key
         conn.setbit(redis_key, uuid, value)
+        if event_name not in self._indexed_events:
+            self._remember_indexed(self._index_events(conn, [event_name]))
+
+    def materialize(self, events):
+        """
+        Run all pending bit operations, needed for `events`, in a single
+        pipeline (or queue them, if a transaction is started)
+        """
+        pipe = self.connection.pipeline() if self.pipe is None else self.pipe
+        steps = self._queue_plan(pipe, events)
+        if self.pipe is None:
+            self._finish_plan(steps, pipe.execute())
+        else:
+            self._finish_plan(steps, None)
+
+    def _queue_plan(self, pipe, events):
+        """
+        Plan bit operations, needed for `events`, and queue them to the
+        pipeline. Return the list of planned steps, pass it to
+        `_finish_plan()` with the pipeline results after the execution.
+
+        Results of finished operations can't change, so if their keys
+        already exist, the operations are skipped. Keys, written while the
+        operation was unfinished, are stale snapshots, and are recognized
+        by their shorter time to live (see `_is_finished_result()`). The
+        check is atomic with a Lua script. If the server doesn't support
+        scripting, keys are checked in advance, with an extra round trip.
+        """
+        steps = planner.plan(events)
+        use_script = self._scripting_supported()
+        finished = [step for step in steps if step.op.event_finished()]
+        existing = set()
+        if finished and not use_script:
+            check = self.connection.pipeline()
+            for step in finished:
+                check.ttl(step.redis_key)
+            existing = {
+                step.redis_key
+                for step, ttl in zip(finished, check.execute())
+                if self._is_finished_result(ttl)
+            }
+        self._queue_steps(pipe, steps, finished, existing, use_script)
+        return steps
+
+    def _queue_steps(self, pipe, steps, finished, existing, use_script):
+        """
+        Queue commands of the planned steps to the pipeline. Steps with
+        keys from `existing` are skipped, and `finished` steps are executed
+        with the "BITOP if missing" script, if `use_script` is set.
+        """
+        finished_keys = {step.redis_key for step in finished}
+        for step in steps:
+            timeout = step.op.expire_timeout()
+            if step.redis_key in existing:
+                step.commands = 0
+                self._count_bitop('hits')
+            elif use_script and step.redis_key in finished_keys:
+                step.commands = 1
+                step.checked = True
+                pipe.eval(BITOP_SCRIPT, 1 + len(step.source_keys),
+                          step.redis_key,
+                          *(step.source_keys + [
+                              step.op_name, timeout or 0,
+                              self.unfinished_ops_expire
+                          ]))
+            else:
+                step.commands = 1
+                pipe.bitop(step.op_name, step.redis_key, *step.source_keys)
+                if timeout is not None:
+                    step.commands += 1
+                    pipe.expire(step.redis_key, timeout)
+            if step.commands and self.record_bitop_expressions:
+                step.commands += 1
+                pipe.set(
+                    self.bitop_expression_key(step.redis_key),
+                    self.bitop_expression(step.op_name, step.source_keys),
+                    ex=timeout)
+
+    def _is_finished_result(self, ttl):
+        """
+        Return True if the key of the bit operation with the given time to
+        live holds the result, computed after the operation was finished:
+        the key is permanent (a rollup), or expires later than results of
+        unfinished operations do.
+        """
+        if ttl is None or ttl == -2:  # no key
+            return False
+        return ttl == -1 or ttl > self.unfinished_ops_expire
+
+    def _finish_plan(self, steps, results):
+        """
+        Mark planned operations as materialized and update cache stats.
+        Return pipeline results, following the planned operations.
+        """
+        pos = 0
+        for step in steps:
+            step.op.materialized = True
+            if step.checked and results is not None:
+                self._count_bitop('misses' if results[pos] else 'hits')
+            elif step.commands and not step.checked:
+                self._count_bitop('misses')
+            pos += step.commands
+        if results is not None:
+            return results[pos:]
+
+    def _count_bitop(self, key):
+        with self._stats_lock:
+            self.bitop_cache_stats[key] += 1
+
+    def get_counts(self, events, use_cache=False):
+        """
+        Return the list of counts of `events` (the same as `len(ev)` for
+        every event) in the same order. All the bit operations and counts
+        are executed in a single pipeline.
+
+        With `use_cache`, counts of finished events are taken from the
+        count cache, and only the missing ones are fetched from bitmaps.
+
+        Example:
+
+            ev = b.DayEvents('active')
+            counts = b.get_counts([ev, ev.prev(), ev & ev.prev()])
+        """
+        finished_keys = (self.count_cache.finished_keys(events)
+                         if use_cache else [])
+        counts = self.count_cache.get_many(finished_keys)
+        missing = self._missing_counts(events, counts)
+        if missing:
+            pipe = self.connection.pipeline()
+            steps = self._queue_plan(pipe, missing.values())
+            for redis_key in missing:
+                pipe.bitcount(redis_key)
+            results = self._finish_plan(steps, pipe.execute())
+            fetched = dict(zip(missing, results))
+            counts.update(fetched)
+            self.count_cache.set_many(
+                self.count_cache.select(fetched, finished_keys))
+        return [counts[event.redis_key] for event in events]
+
+    def _missing_counts(self, events, counts):
+        """
+        Return the ordered mapping from keys to events, missing in `counts`
+        """
+        missing = OrderedDict()
+        for event in events:
+            if event.redis_key not in counts:
+                missing.setdefault(event.redis_key, event)
+        return missing
+
+    def count_series(self, event_name, granularity, start, end=None):
+        """
+        Return the time series of event counts from `start` to `end` (the
+        current moment by default) as a list of `(period_start, count)`
+        tuples, one per period (hour, day, week or month, depending on
+        `granularity`).
+
+        Counts of finished periods are stored in the count cache, so that
+        subsequent calls only fetch the counts of still open periods. Late
+        marks of finished periods invalidate their cached counts.
+
+        Example:
+
+            # Daily actives for the last 90 days
+            start = datetime.datetime.utcnow() - datetime.timedelta(days=89)
+            b.count_series('active', 'day', start)
+        """
+        periods = self._period_range(event_name, granularity, start, end)
+        counts = self.get_counts(periods, use_cache=True)
+        return [(period.period_start(), count)
+                for period, count in zip(periods, counts)]
+
+    def frequency(self, events):
+        """
+        Return the bit-sliced index, counting for every uuid the number of
+        `events` where it's marked. Use it to find uuids marked at least,
+        exactly or between N times.
+
+        Example:
+
+            # Users active on at least 10 of the last 30 days
+            days = [b.DayEvents('active').delta(-i) for i in range(30)]
+            power_users = b.frequency(days).at_least(10)
+        """
+        return bsi.BitSlicedIndex(self, events)
+
+    def backfill_rollups(self, start, end=None, event_names=None):
+        """
+        Compute missing rollups of finished quarters and years from `start`
+        to `end` (the current moment by default) for `event_names` (all
+        events by default). Existing rollups are left as is, so the function
+        is safe to run repeatedly, e.g. from a cron job. Return the number
+        of computed rollups. Rollups of periods without events are empty and
+        aren't stored.
+
+        Example:
+
+            b = Bitmapist(use_rollups=True)
+            b.backfill_rollups(datetime.datetime(2015, 1, 1))
+        """
+        if not self.use_rollups:
+            raise RuntimeError('Rollups are disabled')
+        if event_names is None:
+            event_names = self.get_event_names()
+        misses = self.bitop_cache_stats['misses']
+        self.materialize(self._finished_rollups(start, end, event_names))
+        return self.bitop_cache_stats['misses'] - misses
+
+    def _finished_rollups(self, start, end, event_names):
+        """
+        Return the list of rollups of finished quarters and years from
+        `start` to `end` (the current moment if None)
+        """
+        if end is None:
+            end = datetime.datetime.utcnow()
+        rollups = []
+        for event_name in event_names:
+            quarter = self.QuarterEvents.from_date(event_name, start)
+            while quarter.period_start() <= end:
+                rollups.append(quarter)
+                quarter = quarter.delta(1)
+            for year in range(start.year, end.year + 1):
+                rollups.append(self.YearEvents(event_name, year))
+        return [rollup for rollup in rollups if rollup.event_finished()]
+
+    def user_timeline(self, event_name, uuid, granularity, start, end=None):
+        """
+        Return the activity of the user `uuid` for the event `event_name`
+        over the time range from `start` to `end` (the current moment by
+        default). The activity is a list of booleans, one per period (hour,
+        day, week or month, depending on `granularity`), fetched in a single
+        pipeline.
+
+        Example:
+
+            # Days user 123 was active during the last year
+            now = datetime.datetime.utcnow()
+            year_ago = now - datetime.timedelta(days=365)
+            b.user_timeline('active', 123, 'day', year_ago, now)
+        """
+        periods = self._period_range(event_name, granularity, start, end)
+        pipe = self.connection.pipeline()
+        for period in periods:
+            pipe.getbit(period.redis_key, uuid)
+        return [bool(bit) for bit in pipe.execute()]
+
+    def _period_range(self, event_name, granularity, start, end=None):
+        """
+        Return the list of events of the given granularity ("hour", "day",
+        "week" or "month") for all periods from `start` to `end`
+        """
+        classes = {
+            'hour': self.HourEvents,
+            'day': self.DayEvents,
+            'week': self.WeekEvents,
+            'month': self.MonthEvents,
+        }
+        if granularity not in classes:
+            raise ValueError('Unknown granularity: {}'.format(granularity))
+        if end is None:
+            end = datetime.datetime.utcnow()
+        periods = []
+        period = classes[granularity].from_date(event_name, start)
+        while period.period_start() <= end:
+            periods.append(period)
+            period = period.next()
+        return periods
 
     def get_event_names(self, prefix='', batch=10000):
         """
-        Return the list of all event names, with no particular order. Optional
-        `prefix` value is used to filter only subset of keys
-        """
-        expr = '{}{}*'.format(self.key_prefix, prefix)
-        ret = set()
-        for result in self.connection.scan_iter(match=expr, count=batch):
-            result = result.decode()
-            chunks = result.split('_')
-            event_name = '_'.join(chunks[1:-1])
-            if not event_name.startswith('bitop_'):
-                ret.add(event_name)
+        Return the sorted list of all event names. Optional `prefix` value is
+        used to filter only subset of keys.
+
+        Names are read from the index of events, maintained when events are
+        marked. The index may miss events, marked before it was introduced,
+        so it's used only after `rebuild_event_index()` indexes all the
+        existing events. Until then, or if the server doesn't support sorted
+        sets (like bitmapist-server), names are parsed from the keys found
+        with SCAN.
+        """
+        if (self._server_supports('zset', 'ZCARD', self._probe_key())
+                and self.connection.exists(self.meta_key('events_indexed'))):
+            index_key = self.meta_key('events')
+            min_name, max_name = self._event_index_range(prefix)
+            ret = []
+            while min_name is not None:
+                names = self.connection.zrangebylex(
+                    index_key, min_name, max_name, start=0, num=batch)
+                min_name = self._read_event_index_page(names, batch, ret)
+            return ret
+        return self._scan_event_names(prefix, batch)
+
+    def _event_index_range(self, prefix):
+        """
+        Return the ZRANGEBYLEX interval of names, starting with `prefix`
+        """
+        if not prefix:
+            return '-', '+'
+        # UTF-8 strings never contain the 0xFF byte
+        prefix = prefix.encode()
+        return b'[' + prefix, b'[' + prefix + b'\xff'
+
+    def _read_event_index_page(self, names, batch, ret):
+        """
+        Add names of the ZRANGEBYLEX page of `batch` names to the list
+        `ret`. Return the minimum of the next page, or None if it's the
+        last page.
+        """
+        ret.extend(name.decode() for name in names)
+        if len(names) < batch:
+            return None
+        return b'(' + names[-1]
+
+    def _scan_event_names(self, prefix, batch):
+        """
+        Return the sorted list of event names, parsed from the keys of
+        events
+        """
+        ret = {
+            self._parse_event_name(key)
+            for key in self.connection.scan_iter(
+                match=self._event_keys_pattern(prefix), count=batch)
+        }
+        ret.discard(None)
         return sorted(ret)
 
-    def delete_all_events(self):
+    def _event_keys_pattern(self, prefix):
+        return '{}{}*'.format(self.key_prefix, prefix)
+
+    def _parse_event_name(self, redis_key):
+        """
+        Return the event name of the key, or None for keys of bit operations
+        and metadata
+        """
+        redis_key = redis_key.decode()
+        if redis_key.startswith((self.key_prefix + 'bitop_',
+                                 self.key_prefix + 'meta_')):
+            return None
+        chunks = redis_key[len(self.key_prefix):].split('_')
+        return '_'.join(chunks[:-1])
+
+    def rebuild_event_index(self, batch=10000):
+        """
+        Add the names of all events, found by the keys of events, to the
+        index of event names, e.g. to index events marked with the previous
+        version of the library, and mark the index as complete, so that
+        `get_event_names()` uses it. Return the number of found events.
+
+        The index isn't pruned: names of events, deleted one by one, stay
+        there until `delete_all_events()`.
+        """
+        if not self._server_supports('zset', 'ZCARD', self._probe_key()):
+            raise RuntimeError('Server does not support sorted sets')
+        event_names = self._scan_event_names('', batch)
+        pipe = self.connection.pipeline()
+        self._queue_event_index(pipe, event_names, batch)
+        pipe.execute()
+        self._indexed_events.update(event_names)
+        return len(event_names)
+
+    def _queue_event_index(self, pipe, event_names, batch):
         """
-        Delete all events from the database.
+        Send commands adding `event_names` to the index in batches, and
+        marking the index as complete, to the pipeline
         """
-        keys = self.connection.keys('{}*'.format(self.key_prefix))
-        if keys:
-            self.connection.delete(*keys)
+        index_key = self.meta_key('events')
+        # names are added on top of the index: names, indexed by other
+        # processes while the keys were scanned, must stay there
+        for start in range(0, len(event_names), batch):
+            pipe.execute_command(
+                'ZADD', index_key,
+                *self._event_index_args(event_names[start:start + batch]))
+        pipe.set(self.meta_key('events_indexed'), 1)
 
-    def delete_temporary_bitop_keys(self):
+    def delete_all_events(self, batch_size=1000, pause=0, progress=None):
+        """
+        Delete all events from the database. Return the number of deleted
+        keys.
+
+        Keys are found with SCAN and deleted in batches of `batch_size`
+        keys with UNLINK (DEL if the server doesn't support it), so that
+        the server isn't blocked, and the function is safe to run while
+        events are marked and queried. Optional `pause` is the number of
+        seconds to sleep between batches, and `progress` is a function
+        called after every batch with the number of keys deleted so far.
+        """
+        deleted = self._delete_keys('{}*'.format(self.key_prefix),
+                                    batch_size, pause, progress)
+        # the Redis part of the count cache and the index of events are
+        # deleted with other keys
+        self.count_cache.local.clear()
+        self._indexed_events.clear()
+        return deleted
+
+    def delete_temporary_bitop_keys(self, batch_size=1000, pause=0,
+                                    progress=None):
         """
         Delete all temporary keys that are used when using bit operations.
+        Return the number of deleted keys. Accepts the same arguments as
+        `delete_all_events()`.
+
+        Example:
+
+            # Run from cron, at most 10000 keys a second
+            b.delete_temporary_bitop_keys(batch_size=1000, pause=0.1)
+        """
+        return self._delete_keys('{}bitop_*'.format(self.key_prefix),
+                                 batch_size, pause, progress)
+
+    def _delete_keys(self, pattern, batch_size, pause, progress):
         """
-        keys = self.connection.keys('{}bitop_*'.format(self.key_prefix))
-        if keys:
-            self.connection.delete(*keys)
+        Delete keys matching the pattern in batches. Return the number of
+        deleted keys.
+        """
+        command = self._delete_command()
+        deleted = 0
+        batch = []
+        for key in self.connection.scan_iter(match=pattern, count=batch_size):
+            batch.append(key)
+            if len(batch) < batch_size:
+                continue
+            deleted += self.connection.execute_command(command, *batch)
+            batch = []
+            if progress is not None:
+                progress(deleted)
+            if pause:
+                time.sleep(pause)
+        if batch:
+            deleted += self.connection.execute_command(command, *batch)
+            if progress is not None:
+                progress(deleted)
+        return deleted
+
+    def _delete_command(self):
+        if self._server_supports('unlink', 'UNLINK', self._probe_key()):
+            return 'UNLINK'
+        return 'DEL'
 
     def prefix_key(self, event_name, date):
         return '{}{}_{}'.format(self.key_prefix, event_name, date)
+
+    def bitop_key(self, op_name, source_keys, digest=False):
+        """
+        Return the Redis key for the result of the bit operation.
+
+        By default, the key contains all the source keys. With
+        `hash_bitop_keys` (or `digest`), the key contains a digest of the
+        normalized expression instead, so that its size doesn't depend on
+        the number of operands and the depth of nested operations.
+        """
+        if not (digest or self.hash_bitop_keys):
+            return '{}bitop_{}_{}'.format(self.key_prefix, op_name,
+                                          '-'.join(source_keys))
+        expression = self.bitop_expression(op_name, source_keys)
+        digest = hashlib.sha1(expression.encode('utf-8')).hexdigest()
+        return '{}bitop_{}_{}'.format(self.key_prefix, op_name, digest)
+
+    def bitop_expression(self, op_name, source_keys):
+        """
+        Return the normalized expression of the bit operation. Operands of
+        commutative operations are sorted.
+        """
+        if op_name in ('AND', 'OR', 'XOR'):
+            source_keys = sorted(source_keys)
+        return '{}({})'.format(op_name, ' '.join(source_keys))
+
+    def bitop_expression_key(self, redis_key):
+        """
+        Return the key of the side record with the expression of the bit
+        operation, written with `record_bitop_expressions` for debugging
+        """
+        return '{}bitop_expr_{}'.format(self.key_prefix,
+                                        redis_key[len(self.key_prefix):])
+
+    def meta_key(self, name):
+        """
+        Return the key of an auxiliary structure, like the count cache.
+        These keys are not considered as events.
+        """
+        return '{}meta_{}'.format(self.key_prefix, name)
@@ -1,6 +1,9 @@
-from builtins import range, bytes
+from builtins import range
 import calendar
 import datetime
+import itertools
+
+from bitmapist4.bits import get_bits, iter_set_bits
 
 
 class BaseEvents(object):
@@ -9,6 +12,7 @@ class BaseEvents(object):
     redis_key = None
 
     def has_events_marked(self):
+        self.materialize()
         return self.bitmapist.connection.exists(self.redis_key)
 
     def delete(self):
@@ -20,24 +24,123 @@ class BaseEvents(object):
             return NotImplemented
         return self.redis_key == other_key
 
-    def get_uuids(self):
+    def materialize(self):
+        """
+        Make sure the Redis key of the event exists. Events, derived from
+        bit operations, run them here. Plain events have nothing to do.
+        """
+        return self
+
+    def _bitop(self):
+        """
+        Return the bit operation which creates the Redis key of the event,
+        or None if the key is not derived.
+        """
+        return None
+
+    def get_uuids(self, chunk_size=None):
+        """
+        Yield all uuids of the event in ascending order.
+
+        By default the bitmap is fetched with a single GET. If `chunk_size`
+        (or `read_chunk_size` of the bitmapist object) is set, the bitmap is
+        streamed in windows of `chunk_size` bytes, and empty regions are
+        skipped, so that the memory usage stays bounded for huge bitmaps.
+        """
+        self.materialize()
+        if chunk_size is None:
+            chunk_size = self.bitmapist.read_chunk_size
+        if chunk_size is not None and self.bitmapist._server_supports(
+                'getrange', 'GETRANGE', self.bitmapist._probe_key(), 0, 0):
+            for uuid in self._stream_uuids(0, chunk_size):
+                yield uuid
+            return
+
         val = self.bitmapist.connection.get(self.redis_key)
         if val is None:
             return
 
-        val = bytes(val)
-
-        for char_num, char in enumerate(val):
-            # shortcut
-            if char == 0:
-                continue
-            # find set bits, generate smth like [1, 0, ...]
-            bits = [(char >> i) & 1 for i in range(7, -1, -1)]
-            # list of positions with ones
-            set_bits = list(pos for pos, val in enumerate(bits) if val)
-            # yield everything we need
-            for bit in set_bits:
-                yield char_num * 8 + bit
+        for uuid in iter_set_bits(val):
+            yield uuid
+
+    def _stream_uuids(self, start, chunk_size):
+        """
+        Yield uuids starting from `start`, reading the bitmap with GETRANGE
+        in windows of `chunk_size` bytes. If the server supports BITPOS,
+        every window starts from the first non-empty byte.
+        """
+        conn = self.bitmapist.connection
+        use_bitpos = self.bitmapist._server_supports(
+            'bitpos', 'BITPOS', self.bitmapist._probe_key(), 1)
+        byte = start // 8
+        while True:
+            if use_bitpos:
+                byte = self._skip_to(byte,
+                                     conn.bitpos(self.redis_key, 1, byte))
+                if byte is None:
+                    return
+            data = conn.getrange(self.redis_key, byte, byte + chunk_size - 1)
+            for uuid in self._window_uuids(data, byte, start):
+                yield uuid
+            if len(data) < chunk_size:
+                return
+            byte += chunk_size
+
+    def _skip_to(self, byte, position):
+        """
+        Return the first byte of the next window, given the BITPOS result
+        `position`, or None if there are no set bits after `byte`
+        """
+        if position < 0:
+            return None
+        return max(byte, position // 8)
+
+    def _window_uuids(self, data, byte, start):
+        """
+        Return uuids of the window `data`, starting at `byte`, which are
+        not less than `start`
+        """
+        return (uuid for uuid in iter_set_bits(data, byte * 8)
+                if uuid >= start)
+
+    def page(self, after_uuid=None, limit=100):
+        """
+        Return a page of up to `limit` uuids, following `after_uuid`, and
+        the cursor to fetch the next page. The cursor is None if there are
+        no more pages.
+
+        Only the byte ranges of the bitmap, needed for the page, are fetched,
+        so deep pages cost about the same as the first one.
+
+        Example:
+
+            uuids, cursor = ev.page(limit=50)
+            while cursor is not None:
+                uuids, cursor = ev.page(after_uuid=cursor, limit=50)
+        """
+        self.materialize()
+        start, chunk_size = self._page_window(after_uuid, limit)
+        if self.bitmapist._server_supports(
+                'getrange', 'GETRANGE', self.bitmapist._probe_key(), 0, 0):
+            uuids = self._stream_uuids(start, chunk_size)
+        else:
+            uuids = (uuid for uuid in self.get_uuids() if uuid >= start)
+        return self._page_result(list(itertools.islice(uuids, limit)), limit)
+
+    def _page_window(self, after_uuid, limit):
+        """
+        Return the first uuid of the page, following `after_uuid`, and the
+        size of GETRANGE windows to read it
+        """
+        start = 0 if after_uuid is None else after_uuid + 1
+        return start, max(64, (limit + 7) // 8)
+
+    def _page_result(self, page, limit):
+        """
+        Return the page and the cursor of the next page
+        """
+        cursor = page[-1] if page and len(page) == limit else None
+        return page, cursor
 
     def __iter__(self):
         for item in self.get_uuids():
@@ -56,6 +159,7 @@ class BaseEvents(object):
         return self.bitmapist.BitOpXor(self, other)
 
     def get_count(self):
+        self.materialize()
         count = self.bitmapist.connection.bitcount(self.redis_key)
         return count
 
@@ -63,11 +167,51 @@ class BaseEvents(object):
         return self.get_count()
 
     def __contains__(self, uuid):
+        self.materialize()
         if self.bitmapist.connection.getbit(self.redis_key, uuid):
             return True
         else:
             return False
 
+    def contains_many(self, uuids, batch_size=10000, fetch_threshold=50000):
+        """
+        Check the membership of many uuids at once. Return the list of
+        booleans, one per uuid, in the same order.
+
+        Bits are fetched in chunks of `batch_size` uuids with a single
+        BITFIELD command (or pipelined GETBIT commands if the server
+        doesn't support BITFIELD). If there are at least `fetch_threshold`
+        uuids, the whole bitmap is fetched instead and tested locally.
+
+        Example:
+
+            flags = ev.contains_many(uuids)
+            active = {uuid for uuid, flag in zip(uuids, flags) if flag}
+        """
+        self.materialize()
+        uuids = list(uuids)
+        conn = self.bitmapist.connection
+        if len(uuids) >= fetch_threshold:
+            return get_bits(conn.get(self.redis_key) or b'', uuids)
+
+        use_bitfield = self.bitmapist._server_supports(
+            'bitfield', 'BITFIELD', self.bitmapist._probe_key(), 'GET', 'u1',
+            0)
+        ret = []
+        for start in range(0, len(uuids), batch_size):
+            chunk = uuids[start:start + batch_size]
+            if use_bitfield:
+                bits = conn.execute_command(
+                    'BITFIELD', self.redis_key,
+                    *self.bitmapist._bitfield_args('GET', chunk))
+            else:
+                pipe = conn.pipeline()
+                for uuid in chunk:
+                    pipe.getbit(self.redis_key, uuid)
+                bits = pipe.execute()
+            ret.extend(bool(bit) for bit in bits)
+        return ret
+
     def delta(self, value):
         raise NotImplementedError('Must be implemented in subclass')
 
@@ -112,7 +256,43 @@ class UniqueEvents(BaseEvents):
         return False
 
 
-class YearEvents(BaseEvents):
+class DerivedEvents(BaseEvents):
+    """
+    Base class for events, derived from other events with a bit operation
+    `parts_op`.
+    """
+
+    parts_op = None
+
+    def materialize(self):
+        self.parts_op.materialize()
+        return self
+
+    def _bitop(self):
+        return self.parts_op
+
+
+class RollupEvents(DerivedEvents):
+    """
+    Base class for events of long periods, derived from shorter periods by
+    OR-ing them (e.g. a year is derived from 12 months).
+
+    By default the result is a temporary bit operation. With `use_rollups`,
+    results for finished periods are stored permanently under the rollup
+    key, and are computed only once.
+    """
+
+    def _init_parts(self, parts, rollup_suffix):
+        if self.bitmapist.use_rollups and self.event_finished():
+            rollup_key = self.bitmapist.prefix_key(self.event_name,
+                                                   rollup_suffix)
+            self.parts_op = self.bitmapist.Rollup(rollup_key, *parts)
+        else:
+            self.parts_op = self.bitmapist.BitOpOr(*parts)
+        self.redis_key = self.parts_op.redis_key
+
+
+class YearEvents(RollupEvents):
     """
     Events for a year.
 
@@ -134,8 +314,7 @@ class YearEvents(BaseEvents):
         months = []
         for m in range(1, 13):
             months.append(self.bitmapist.MonthEvents(event_name, self.year, m))
-        or_op = self.bitmapist.BitOpOr(*months)
-        self.redis_key = or_op.redis_key
+        self._init_parts(months, 'Y%s' % self.year)
 
     def delta(self, value):
         return self.__class__(self.event_name, self.year + value)
@@ -151,6 +330,48 @@ class YearEvents(BaseEvents):
                 '{self.year})').format(self=self)
 
 
+class QuarterEvents(RollupEvents):
+    """
+    Events for a quarter.
+
+    Example::
+
+        QuarterEvents('active', 2012, 4)
+    """
+
+    @classmethod
+    def from_date(cls, event_name, dt=None):
+        dt = dt or datetime.datetime.utcnow()
+        return cls(event_name, dt.year, (dt.month - 1) // 3 + 1)
+
+    def __init__(self, event_name, year=None, quarter=None):
+        now = datetime.datetime.utcnow()
+        self.event_name = event_name
+        self.year = not_none(year, now.year)
+        self.quarter = not_none(quarter, (now.month - 1) // 3 + 1)
+
+        months = []
+        for m in range(self.quarter * 3 - 2, self.quarter * 3 + 1):
+            months.append(self.bitmapist.MonthEvents(event_name, self.year, m))
+        self._init_parts(months, 'Q%s-%s' % (self.year, self.quarter))
+
+    def delta(self, value):
+        year, quarter = divmod(self.year * 4 + self.quarter - 1 + value, 4)
+        return self.__class__(self.event_name, year, quarter + 1)
+
+    def period_start(self):
+        return datetime.datetime(self.year, self.quarter * 3 - 2, 1)
+
+    def period_end(self):
+        _, day = calendar.monthrange(self.year, self.quarter * 3)
+        return datetime.datetime(self.year, self.quarter * 3, day, 23, 59, 59,
+                                 999999)
+
+    def __repr__(self):
+        return ('{self.__class__.__name__}("{self.event_name}", {self.year}, '
+                '{self.quarter})').format(self=self)
+
+
 class MonthEvents(BaseEvents):
     """
     Events for a month.
@@ -315,6 +536,135 @@ class HourEvents(BaseEvents):
                 '{self.month}, {self.day}, {self.hour})').format(self=self)
 
 
+class RangeEvents(DerivedEvents):
+    """
+    Events for an arbitrary range of days (or hours, with `hourly=True`)
+    from `start` to `end`, both inclusive.
+
+    The range is covered with the smallest number of months, weeks and days
+    that lie within it (and hours at the edges of hourly ranges), found as
+    the shortest path over days. Their bitmaps are OR-ed in a single BITOP.
+    E.g. the range from Jan 3 to Apr 19, 2018 takes 20 operands (2 months,
+    5 weeks and 13 days) instead of 107 days, and the range from Jan 29 to
+    Mar 4, 2018 takes 5 weeks, not a month and 10 days.
+
+    Example::
+
+        RangeEvents('active', datetime(2018, 3, 3), datetime(2018, 4, 19))
+    """
+
+    def __init__(self, event_name, start, end=None, hourly=False):
+        self.event_name = event_name
+        self.start = to_datetime(start)
+        self.end = to_datetime(not_none(end, datetime.datetime.utcnow()))
+        self.hourly = hourly
+        if self.start > self.end:
+            raise ValueError('Start of the range is after its end')
+        self.parts = self._cover()
+        self.parts_op = self.bitmapist.BitOpOr(*self.parts)
+        self.redis_key = self.parts_op.redis_key
+
+    def _cover(self):
+        """
+        Return the list of events covering the range
+        """
+        first_day, last_day = self.start.date(), self.end.date()
+        parts = []
+        if self.hourly and self.start.hour > 0:
+            last_hour = self.end.hour if first_day == last_day else 23
+            parts.extend(self._hours(first_day, self.start.hour, last_hour))
+            first_day += datetime.timedelta(days=1)
+        if first_day > last_day:
+            return parts
+
+        tail = []
+        if self.hourly and self.end.hour < 23:
+            tail = self._hours(last_day, 0, self.end.hour)
+            last_day -= datetime.timedelta(days=1)
+
+        end = last_day + datetime.timedelta(days=1)
+        return parts + self._cover_days(first_day, end) + tail
+
+    def _cover_days(self, start, end):
+        """
+        Return the shortest list of months, weeks and days, covering days
+        from `start` (inclusive) to `end` (exclusive)
+        """
+        size = (end - start).days
+        # count[i] is the number of periods in the shortest cover of the
+        # first i days, and last[i] is the last period of that cover as
+        # (index of its first day, period kind)
+        count = [0] + [None] * size
+        last = [None] * (size + 1)
+        for i in range(size):
+            day = start + datetime.timedelta(days=i)
+            periods = [(1, 'day')]
+            if day.weekday() == 0:
+                periods.append((7, 'week'))
+            if day.day == 1:
+                periods.append(((next_month(day) - day).days, 'month'))
+            for length, kind in periods:
+                j = i + length
+                # on ties, the earlier start (the longer period) wins
+                if j <= size and (count[j] is None
+                                  or count[i] + 1 < count[j]):
+                    count[j] = count[i] + 1
+                    last[j] = (i, kind)
+
+        parts = []
+        j = size
+        while j > 0:
+            j, kind = last[j]
+            day = start + datetime.timedelta(days=j)
+            if kind == 'month':
+                parts.append(
+                    self.bitmapist.MonthEvents(self.event_name, day.year,
+                                               day.month))
+            elif kind == 'week':
+                parts.append(
+                    self.bitmapist.WeekEvents.from_date(self.event_name, day))
+            else:
+                parts.append(
+                    self.bitmapist.DayEvents(self.event_name, day.year,
+                                             day.month, day.day))
+        parts.reverse()
+        return parts
+
+    def _hours(self, day, first_hour, last_hour):
+        return [
+            self.bitmapist.HourEvents(self.event_name, day.year, day.month,
+                                      day.day, hour)
+            for hour in range(first_hour, last_hour + 1)
+        ]
+
+    def delta(self, value):
+        """
+        Return the adjacent range of the same length, shifted by `value`
+        lengths
+        """
+        shift = (self.period_end() - self.period_start() +
+                 datetime.timedelta(microseconds=1)) * value
+        return self.__class__(self.event_name, self.start + shift,
+                              self.end + shift, self.hourly)
+
+    def period_start(self):
+        if self.hourly:
+            return self.start.replace(minute=0, second=0, microsecond=0)
+        return datetime.datetime(self.start.year, self.start.month,
+                                 self.start.day)
+
+    def period_end(self):
+        if self.hourly:
+            return self.end.replace(minute=59, second=59, microsecond=999999)
+        return datetime.datetime(self.end.year, self.end.month, self.end.day,
+                                 23, 59, 59, 999999)
+
+    def __repr__(self):
+        return ('{self.__class__.__name__}("{self.event_name}", '
+                '{self.start!r}, {self.end!r}, hourly={self.hourly})').format(
+                    self=self)
+
+
 class BitOperation(BaseEvents):
     """
     Base class for bit operations (AND, OR, XOR).
@@ -325,6 +675,12 @@ class BitOperation(BaseEvents):
 
     You can even nest bit operations.
 
+    Bit operations are lazy. Creating the object doesn't touch Redis,
+    the operation runs on the first access to its result (len(), `in`,
+    iteration, etc.), or on explicit call of `materialize()`. At this point,
+    the whole tree of nested operations is planned and sent to Redis in a
+    single pipeline (see `bitmapist4.planner`).
+
     Example::
 
         active_2_months = BitOpAnd(
@@ -343,22 +699,30 @@ class BitOperation(BaseEvents):
     """
 
     def __init__(self, op_name, *events):
+        self.op_name = op_name
         self.events = events
-        event_redis_keys = [ev.redis_key for ev in events]
-        self.redis_key = '%sbitop_%s_%s' % (self.bitmapist.key_prefix, op_name,
-                                            '-'.join(event_redis_keys))
-        if self.bitmapist.pipe is not None:
-            pipe = self.bitmapist.pipe
-        else:
-            pipe = self.bitmapist.connection.pipeline()
+        self.redis_key = self.bitmapist.bitop_key(
+            op_name, [ev.redis_key for ev in events])
+        self.materialized = False
+
+    # can the planner merge the operation into the parent of the same type
+    inlinable = True
+
+    def materialize(self):
+        if not self.materialized:
+            self.bitmapist.materialize([self])
+        return self
+
+    def _bitop(self):
+        return self
+
+    def expire_timeout(self):
+        """
+        Return the time to live of the key with the result of the operation
+        """
         if self.event_finished():
-            timeout = self.bitmapist.finished_ops_expire
-        else:
-            timeout = self.bitmapist.unfinished_ops_expire
-        pipe.bitop(op_name, self.redis_key, *event_redis_keys)
-        pipe.expire(self.redis_key, timeout)
-        if not self.bitmapist.pipe:
-            pipe.execute()
+            return self.bitmapist.finished_ops_expire
+        return self.bitmapist.unfinished_ops_expire
 
     def delta(self, value):
         events = [ev.delta(value) for ev in self.events]
@@ -378,6 +742,28 @@ class BitOperation(BaseEvents):
         return '{0.__class__.__name__}({1})'.format(self, ev_repr)
 
 
+class Rollup(BitOperation):
+    """
+    OR of events, stored permanently under the given key. Used by
+    RollupEvents for finished periods. The operation is executed only if
+    the key doesn't exist yet.
+    """
+
+    inlinable = False
+
+    def __init__(self, redis_key, *events):
+        self.op_name = 'OR'
+        self.events = events
+        self.redis_key = redis_key
+        self.materialized = False
+
+    def expire_timeout(self):
+        return None
+
+    def delta(self, value):
+        raise NotImplementedError('Use delta() of RollupEvents instead')
+
+
 class BitOpAnd(BitOperation):
     def __init__(self, *events):
         super(BitOpAnd, self).__init__('AND', *events)
@@ -419,6 +805,24 @@ def not_none(*keys):
             return key
 
 
+def to_datetime(value):
+    """
+    Convert a date to the datetime of its midnight. Datetimes are returned
+    as is.
+    """
+    if isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime(value.year, value.month, value.day)
+
+
+def next_month(day):
+    """
+    The first day of the month, following the month of `day`
+    """
+    year, month = add_month(day.year, day.month, 1)
+    return day.replace(year=year, month=month, day=1)
+
+
 def iso_year_start(iso_year):
     """
     The gregorian calendar date of the first day of the given ISO year
@@ -0,0 +1,122 @@
+"""
+Funnel is a sequence of steps, subjects go through on the way to a goal
+(e.g. signup, then creating a project, then inviting a teammate).
+
+You can get the conversion of every step with `get_funnel()` function, and
+then export it to Pandas dataframe with df() method.
+
+    from bitmapist4.funnel import get_funnel
+
+    funnel = get_funnel([
+        b.WeekEvents('signup'),
+        b.WeekEvents('project:created'),
+        b.WeekEvents('teammate:invited'),
+    ], window=2)
+
+Users of every step are users of the previous step AND the event of the
+step, so each step reuses the result of the previous one. All bit
+operations and counts are executed in a single pipeline.
+"""
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+
+def get_funnel(steps, window=None, use_cache=False):
+    # type: (list, int, bool) -> "Funnel"
+    """
+    Return the funnel for the list of events `steps`. The first step
+    defines the cohort (e.g. users signed up this week), and every next
+    step keeps users of the previous step, who also have the event of the
+    step.
+
+    By default, the events of all steps are taken for the same periods as
+    provided. With `window`, the event of every step after the first one
+    counts if it happened in the same period, or up to `window` periods
+    (days, weeks, etc.) after, e.g. to see who created a project within 2
+    weeks after the signup.
+
+    Please note that bitmaps don't keep the order of events within a period,
+    so events of the same period count even if they happened before the
+    previous step.
+
+    With `use_cache`, counts of finished steps are taken from the count
+    cache (see `Bitmapist.count_cache`).
+    """
+    if not steps:
+        raise ValueError('Funnel needs at least one step')
+    bitmapist = steps[0].bitmapist
+
+    users = [steps[0]]
+    for step in steps[1:]:
+        if window:
+            step = bitmapist.BitOpOr(
+                *[step.delta(offset) for offset in range(window + 1)])
+        # AND of the previous step and this one, not of all the steps up to
+        # this one: the planner executes it as a separate BITOP, reused by
+        # the next step
+        users.append(users[-1] & step)
+
+    counts = bitmapist.get_counts(users, use_cache=use_cache)
+    funnel = Funnel()
+    for step, count in zip(steps, counts):
+        funnel.add_step(_step_name(step), count)
+    return funnel
+
+
+def _step_name(event):
+    return getattr(event, 'event_name', None) or repr(event)
+
+
+class Funnel(object):
+    def __init__(self, steps=None):
+        self.steps = steps or []
+
+    def add_step(self, name, count):
+        if self.steps:
+            previous, first = self.steps[-1].count, self.steps[0].count
+        else:
+            previous = first = count
+        self.steps.append(
+            FunnelStep(name, count, _percent(count, previous),
+                       _percent(count, first)))
+
+    def __repr__(self):
+        body = ',\n  '.join(repr(step) for step in self.steps)
+        return 'Funnel([\n  {}])'.format(body)
+
+    def df(self):
+        if pd is None:
+            raise RuntimeError('Please pandas library')
+        records = [(step.count, step.conversion, step.total_conversion)
+                   for step in self.steps]
+        index = [step.name for step in self.steps]
+        return pd.DataFrame.from_records(
+            records,
+            index=index,
+            columns=['count', 'conversion', 'total_conversion'])
+
+
+class FunnelStep(object):
+    """
+    Step of the funnel: the number of subjects, who got to the step, and
+    the percent of subjects of the previous (`conversion`) and the first
+    (`total_conversion`) step.
+    """
+
+    def __init__(self, name, count, conversion, total_conversion):
+        self.name = name
+        self.count = count
+        self.conversion = conversion
+        self.total_conversion = total_conversion
+
+    def __repr__(self):
+        return ('FunnelStep({0.name!r}, {0.count}, {0.conversion:.1f}, '
+                '{0.total_conversion:.1f})').format(self)
+
+
+def _percent(value, base):
+    if base == 0:
+        return 0
+    return value * 100.0 / base
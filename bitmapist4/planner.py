@@ -0,0 +1,111 @@
+"""
+Query planner for bit operations.
+
+Bit operations form a DAG of lazy expressions. Before sending them to Redis,
+the planner
+
+- skips operations, which are already materialized,
+- removes common subexpressions: operations with the same Redis key are
+  executed once,
+- flattens nested operations of the same associative type into one n-ary
+  BITOP, e.g. `(a & b) & c` becomes `BITOP AND dest a b c`, unless the
+  nested operation is requested explicitly, shared with other operations,
+  or is a permanent rollup,
+- removes duplicate operands of AND and OR.
+
+The plan is a list of steps in the execution order: every step comes after
+all the steps it depends on.
+"""
+from collections import OrderedDict, defaultdict
+
+ASSOCIATIVE_OPS = ('AND', 'OR', 'XOR')
+IDEMPOTENT_OPS = ('AND', 'OR')
+
+
+class Step(object):
+    """
+    A single BITOP command of the plan
+    """
+
+    def __init__(self, op, source_keys):
+        self.op = op
+        self.op_name = op.op_name
+        self.redis_key = op.redis_key
+        self.source_keys = source_keys
+        # number of commands queued to the pipeline to execute the step
+        self.commands = 0
+        # True if the step is executed with the "BITOP if missing" script
+        self.checked = False
+
+    def __repr__(self):
+        return 'Step({0.op_name}, {0.redis_key!r}, {0.source_keys!r})'.format(
+            self)
+
+
+def plan(events):
+    """
+    Return the list of steps to materialize all `events`
+    """
+    roots = OrderedDict()
+    for event in events:
+        op = _pending_op(event)
+        if op is not None:
+            roots.setdefault(op.redis_key, op)
+
+    # number of references to every pending operation from other operations
+    refcount = defaultdict(int)
+    visited = set()
+
+    def count(op):
+        if op.redis_key in visited:
+            return
+        visited.add(op.redis_key)
+        for operand in op.events:
+            child = _pending_op(operand)
+            if child is not None:
+                refcount[child.redis_key] += 1
+                count(child)
+
+    for op in roots.values():
+        count(op)
+
+    steps = []
+    planned = set()
+
+    def inlined(parent, child):
+        return (parent.op_name in ASSOCIATIVE_OPS
+                and child.inlinable
+                and child.op_name == parent.op_name
+                and child.redis_key not in roots
+                and refcount[child.redis_key] == 1)
+
+    def source_keys(op):
+        keys = []
+        for operand in op.events:
+            child = _pending_op(operand)
+            if child is not None and inlined(op, child):
+                keys.extend(source_keys(child))
+                continue
+            if child is not None:
+                emit(child)
+            keys.append(operand.redis_key)
+        if op.op_name in IDEMPOTENT_OPS:
+            keys = list(OrderedDict.fromkeys(keys))
+        return keys
+
+    def emit(op):
+        if op.redis_key in planned:
+            return
+        planned.add(op.redis_key)
+        steps.append(Step(op, source_keys(op)))
+
+    for op in roots.values():
+        emit(op)
+    return steps
+
+
+def _pending_op(event):
+    op = event._bitop()
+    if op is None or op.materialized:
+        return None
+    return op
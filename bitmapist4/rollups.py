@@ -0,0 +1,40 @@
+"""
+Command line tool to backfill rollups of finished years and quarters.
+
+    python -m bitmapist4.rollups --url redis://localhost --start 2015-01-01
+
+Safe to run repeatedly: existing rollups are left as is.
+"""
+import argparse
+import datetime
+
+from bitmapist4.core import Bitmapist
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Backfill rollups of finished years and quarters')
+    parser.add_argument('--url', default='redis://localhost',
+                        help='Redis URL (default: %(default)s)')
+    parser.add_argument('--key-prefix', default='bitmapist_',
+                        help='prefix of bitmapist keys (default: %(default)s)')
+    parser.add_argument('--start', type=parse_date, required=True,
+                        help='start date, YYYY-MM-DD')
+    parser.add_argument('--end', type=parse_date,
+                        help='end date, YYYY-MM-DD (default: now)')
+    parser.add_argument('--event', dest='event_names', action='append',
+                        help='event name (default: all events), can be '
+                        'repeated')
+    args = parser.parse_args(argv)
+
+    b = Bitmapist(args.url, key_prefix=args.key_prefix, use_rollups=True)
+    count = b.backfill_rollups(args.start, args.end, args.event_names)
+    print('Computed {} rollups'.format(count))
+
+
+if __name__ == '__main__':
+    main()
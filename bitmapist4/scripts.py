@@ -0,0 +1,93 @@
+"""
+Lua scripts executed on the Redis server side.
+"""
+
+# Mark an event for all the granularities with a single command. Key names
+# are derived from the timestamp on the server and must be identical to
+# the ones created by `from_date()` of MonthEvents, WeekEvents, DayEvents,
+# HourEvents and UniqueEvents.
+#
+# ARGV: key prefix, event name, uuid, value (0 or 1), unix timestamp,
+#       track hourly (0 or 1), track unique (0 or 1)
+MARK_SCRIPT = """
+local prefix, event_name = ARGV[1], ARGV[2]
+local uuid, value, ts = tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+
+-- http://howardhinnant.github.io/date_algorithms.html
+local function days_from_civil(y, m, d)
+    if m <= 2 then y = y - 1 end
+    local era = math.floor(y / 400)
+    local yoe = y - era * 400
+    local mp = (m > 2) and (m - 3) or (m + 9)
+    local doy = math.floor((153 * mp + 2) / 5) + d - 1
+    local doe = yoe * 365 + math.floor(yoe / 4) - math.floor(yoe / 100) + doy
+    return era * 146097 + doe - 719468
+end
+
+local function civil_from_days(z)
+    z = z + 719468
+    local era = math.floor(z / 146097)
+    local doe = z - era * 146097
+    local yoe = math.floor((doe - math.floor(doe / 1460) +
+        math.floor(doe / 36524) - math.floor(doe / 146096)) / 365)
+    local doy = doe - (365 * yoe + math.floor(yoe / 4) - math.floor(yoe / 100))
+    local mp = math.floor((5 * doy + 2) / 153)
+    local d = doy - math.floor((153 * mp + 2) / 5) + 1
+    local m = (mp < 10) and (mp + 3) or (mp - 9)
+    local y = yoe + era * 400
+    if m <= 2 then y = y + 1 end
+    return y, m, d
+end
+
+local days = math.floor(ts / 86400)
+local hour = math.floor((ts - days * 86400) / 3600)
+local year, month, day = civil_from_days(days)
+
+-- ISO week belongs to the year of its Thursday (1970-01-01 is a Thursday)
+local weekday = (days + 3) % 7 + 1
+local thursday = days - weekday + 4
+local iso_year = civil_from_days(thursday)
+local iso_week = math.floor(
+    (thursday - days_from_civil(iso_year, 1, 1)) / 7) + 1
+
+local base = prefix .. event_name .. '_'
+local keys = {
+    base .. string.format('%d-%d', year, month),
+    base .. string.format('W%d-%d', iso_year, iso_week),
+    base .. string.format('%d-%d-%d', year, month, day),
+}
+if ARGV[6] == '1' then
+    table.insert(keys,
+        base .. string.format('%d-%d-%d-%d', year, month, day, hour))
+end
+if ARGV[7] == '1' then
+    table.insert(keys, base .. 'u')
+end
+for _, key in ipairs(keys) do
+    redis.call('SETBIT', key, uuid, value)
+end
+return #keys
+"""
+
+# Run BITOP, unless the destination key already holds a finished result,
+# and set the expiration time of the destination key. Return 1 if the
+# operation was executed, and 0 if the key was reused.
+#
+# The key holds a finished result if it's permanent, or expires later than
+# results of unfinished operations would: a key, written while its period
+# was still open, is a stale snapshot.
+#
+# KEYS: destination key, source keys
+# ARGV: operation name, expiration time in seconds (0 for permanent keys),
+#       expiration time of unfinished operations
+BITOP_SCRIPT = """
+local ttl = redis.call('TTL', KEYS[1])
+if ttl == -1 or ttl > tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('BITOP', ARGV[1], unpack(KEYS))
+if tonumber(ARGV[2]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+"""
@@ -0,0 +1,148 @@
+"""
+Buffered writer, sending marked events to Redis from a background thread.
+
+Use `Bitmapist.start_buffering()` to enable it.
+"""
+import atexit
+import logging
+import threading
+import time
+from queue import Queue, Full, Empty
+
+logger = logging.getLogger(__name__)
+
+# Queue item asking the background thread to exit
+_STOP = object()
+
+
+def _unregister(func):
+    """
+    Remove the exit handler. Python 2 can't do it, and the handler of a
+    closed writer stays registered there, doing nothing.
+    """
+    if hasattr(atexit, 'unregister'):
+        atexit.unregister(func)
+
+
+class _Barrier(object):
+    """
+    Queue item, marking the moment all previous events are sent to Redis
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+
+
+class BufferedWriter(object):
+    """
+    Background writer draining an in-process queue of marked events into
+    Redis pipelines.
+
+    Queue items are tuples with arguments of `Bitmapist._queue_mark()`:
+    (event_name, uuid, timestamp, value, track_hourly, track_unique)
+    """
+
+    def __init__(self,
+                 bitmapist,
+                 batch_size=1000,
+                 flush_interval=1.0,
+                 max_queue_size=100000,
+                 on_full='block'):
+        if on_full not in ('block', 'drop'):
+            raise ValueError('on_full must be either "block" or "drop"')
+        self.bitmapist = bitmapist
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_full = on_full
+        self.queue = Queue(max_queue_size)
+        self.dropped = 0
+        self.errors = 0
+        self.closed = False
+        self.thread = threading.Thread(
+            target=self._run, name='bitmapist-writer')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def put(self, item):
+        if self.closed:
+            raise RuntimeError('Writer is closed')
+        if self.on_full == 'block':
+            self.queue.put(item)
+            return
+        try:
+            self.queue.put_nowait(item)
+        except Full:
+            self.dropped += 1
+
+    def flush(self, timeout=None):
+        """
+        Wait until all events put to the queue so far are sent to Redis.
+        Return False if the timeout is over before, including the time
+        spent waiting for a free slot in the full queue.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        barrier = _Barrier()
+        try:
+            self.queue.put(barrier, timeout=timeout)
+        except Full:
+            return False
+        if deadline is not None:
+            timeout = max(0, deadline - time.time())
+        return barrier.event.wait(timeout)
+
+    def close(self, timeout=None):
+        """
+        Send all pending events to Redis and stop the background thread
+        """
+        if self.closed:
+            return
+        self.closed = True
+        _unregister(self.close)
+        self.queue.put(_STOP)
+        self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            items, barriers, stop = self._collect()
+            if items:
+                self._write(items)
+            for barrier in barriers:
+                barrier.event.set()
+            if stop:
+                return
+
+    def _collect(self):
+        """
+        Collect the next batch of events from the queue. Return a tuple
+        (items, barriers, stop)
+        """
+        items = []
+        deadline = time.time() + self.flush_interval
+        while len(items) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except Empty:
+                break
+            if item is _STOP:
+                return items, [], True
+            if isinstance(item, _Barrier):
+                return items, [item], False
+            items.append(item)
+        return items, [], False
+
+    def _write(self, items):
+        try:
+            pipe = self.bitmapist.connection.pipeline()
+            indexed = []
+            for item in items:
+                indexed.extend(self.bitmapist._queue_mark(pipe, *item))
+            pipe.execute()
+            self.bitmapist._indexed_events.update(indexed)
+        except Exception:
+            self.errors += 1
+            logger.exception('Failed to write %d events to Redis',
+                             len(items))
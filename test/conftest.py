@@ -2,6 +2,7 @@ from builtins import range
 
 import pytest
 import os
+import sys
 import subprocess
 import atexit
 import socket
@@ -9,6 +10,10 @@ import time
 import redis
 import bitmapist4
 
+collect_ignore = []
+if sys.version_info < (3, 7):
+    collect_ignore.append('test_aio.py')
+
 REDIS_HOST = '127.0.0.1'
 REDIS_PORT = 6399
 
@@ -51,6 +56,22 @@ def bitmapist_non_unique(redis_server):
     flushall(conn)
 
 
+@pytest.fixture
+def bitmapist_scripting(redis_server):
+    conn = redis.StrictRedis(*redis_server)
+    obj = bitmapist4.Bitmapist(conn, track_hourly=True, use_scripting=True)
+    yield obj
+    flushall(conn)
+
+
+@pytest.fixture
+def bitmapist_rollups(redis_server):
+    conn = redis.StrictRedis(*redis_server)
+    obj = bitmapist4.Bitmapist(conn, use_rollups=True)
+    yield obj
+    flushall(conn)
+
+
 @pytest.fixture
 def bitmapist_copy(redis_server):
     conn = redis.StrictRedis(*redis_server)
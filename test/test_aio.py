@@ -0,0 +1,355 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+import redis
+
+aioredis = pytest.importorskip('redis.asyncio')
+
+from bitmapist4.aio import AsyncBitmapist  # noqa: E402
+from .conftest import flushall  # noqa: E402
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def abitmapist(redis_server, loop):
+    host, port = redis_server
+    conn = aioredis.StrictRedis(host=host, port=port)
+    obj = AsyncBitmapist(conn, track_hourly=True)
+    yield obj
+    flushall(redis.StrictRedis(*redis_server))
+    loop.run_until_complete(conn.connection_pool.disconnect())
+
+
+async def collect(ev):
+    return [uuid async for uuid in ev]
+
+
+def test_mark(abitmapist, loop):
+    async def run():
+        await abitmapist.mark_event('active', 123)
+        ev = abitmapist.DayEvents('active')
+        assert await ev.contains(123)
+        assert not await ev.contains(124)
+        assert await ev.get_count() == 1
+        assert await ev.has_events_marked()
+        await abitmapist.unmark_event('active', 123)
+        assert not await ev.contains(123)
+
+    loop.run_until_complete(run())
+
+
+def test_sync_protocols_are_disabled(abitmapist):
+    ev = abitmapist.DayEvents('active')
+    with pytest.raises(TypeError):
+        len(ev)
+    with pytest.raises(TypeError):
+        1 in ev
+
+
+def test_iter_and_bit_operations(abitmapist, loop):
+    async def run():
+        await abitmapist.mark_events([('foo', 1, None), ('foo', 2, None),
+                                      ('bar', 2, None), ('bar', 3, None)])
+        foo = abitmapist.DayEvents('foo')
+        bar = abitmapist.DayEvents('bar')
+        assert await collect(foo) == [1, 2]
+        assert await collect(foo & bar) == [2]
+        assert await collect(foo | bar) == [1, 2, 3]
+        assert await collect(~foo & bar) == [3]
+        op = await (foo ^ bar)
+        assert await op.get_count() == 2
+        counts = await asyncio.gather(foo.get_count(), bar.get_count(),
+                                      (foo & bar).get_count())
+        assert counts == [2, 2, 1]
+
+    loop.run_until_complete(run())
+
+
+def test_year_events(abitmapist, loop):
+    async def run():
+        await abitmapist.mark_event('foo', 1)
+        assert await abitmapist.YearEvents('foo').contains(1)
+
+    loop.run_until_complete(run())
+
+
+def test_transaction(abitmapist, loop):
+    async def run():
+        yesterday = datetime.utcnow() - timedelta(days=1)
+        async with abitmapist.transaction():
+            await abitmapist.mark_event('active', 1)
+            await abitmapist.mark_event('active', 2, timestamp=yesterday)
+            await abitmapist.mark_unique('premium', 1)
+            assert await abitmapist.DayEvents('active').get_count() == 0
+        assert await collect(abitmapist.DayEvents('active')) == [1]
+        assert await collect(abitmapist.UniqueEvents('premium')) == [1]
+        assert await abitmapist.get_event_names() == ['active', 'premium']
+
+    loop.run_until_complete(run())
+
+
+def test_delete_keys(abitmapist, loop):
+    async def run():
+        await abitmapist.mark_events([('foo', 1, None), ('bar', 2, None)])
+        foo = abitmapist.DayEvents('foo')
+        await (foo | abitmapist.DayEvents('bar'))
+        assert await abitmapist.delete_temporary_bitop_keys() == 1
+        assert await foo.contains(1)
+        progress = []
+        deleted = await abitmapist.delete_all_events(
+            batch_size=2, progress=progress.append)
+        assert deleted > 2
+        assert progress[-1] == deleted
+        assert not await foo.contains(1)
+
+    loop.run_until_complete(run())
+
+
+def test_event_index(abitmapist, loop):
+    async def run():
+        await abitmapist.mark_event('song_played', 1)
+        await abitmapist.mark_events([('song_liked', 1, None)])
+        await abitmapist.mark_unique('premium', 1)
+        assert await abitmapist.get_event_names() == [
+            'premium', 'song_liked', 'song_played'
+        ]
+        assert await abitmapist.get_event_names(prefix='song_') == [
+            'song_liked', 'song_played'
+        ]
+        assert await abitmapist.rebuild_event_index() == 3
+        await abitmapist.connection.setbit('bitmapist_unindexed_2018-1', 1,
+                                           1)
+        assert await abitmapist.get_event_names(prefix='song_', batch=1) == [
+            'song_liked', 'song_played'
+        ]
+        assert await abitmapist.get_event_names() == [
+            'premium', 'song_liked', 'song_played'
+        ]
+
+    loop.run_until_complete(run())
+
+
+def test_bit_operations_are_planned(abitmapist, loop):
+    async def run():
+        abitmapist.record_bitop_expressions = True
+        await abitmapist.mark_events([('a', 1, datetime(2018, 1, 1)),
+                                      ('b', 1, datetime(2018, 1, 1)),
+                                      ('c', 2, datetime(2018, 1, 1))])
+        a = abitmapist.DayEvents('a', 2018, 1, 1)
+        b = abitmapist.DayEvents('b', 2018, 1, 1)
+        c = abitmapist.DayEvents('c', 2018, 1, 1)
+        shared = a & b
+        op = ((shared | c) | c) ^ (shared & a)
+        assert await collect(op) == [2]
+        # (shared | c) | c is flattened, shared is computed once
+        assert abitmapist.bitop_cache_stats == {'hits': 0, 'misses': 4}
+        expression = await abitmapist.connection.get(
+            abitmapist.bitop_expression_key(op.redis_key))
+        assert expression.decode().startswith('XOR(')
+
+        # the result of the finished operation is reused
+        same = (abitmapist.DayEvents('a', 2018, 1, 1) &
+                abitmapist.DayEvents('b', 2018, 1, 1))
+        assert await same.get_count() == 1
+        assert abitmapist.bitop_cache_stats == {'hits': 1, 'misses': 4}
+
+    loop.run_until_complete(run())
+
+
+def test_bit_operations_in_transaction(abitmapist, loop):
+    async def run():
+        await abitmapist.mark_event('a', 1)
+        a = abitmapist.DayEvents('a')
+        async with abitmapist.transaction():
+            op = await (a | a.prev())
+        assert await op.get_count() == 1
+
+    loop.run_until_complete(run())
+
+
+def test_get_counts(abitmapist, loop):
+    async def run():
+        await abitmapist.mark_events([('a', 1, datetime(2018, 1, 1)),
+                                      ('a', 2, datetime(2018, 1, 1)),
+                                      ('b', 2, datetime(2018, 1, 1)),
+                                      ('a', 1, None)])
+        a = abitmapist.DayEvents('a', 2018, 1, 1)
+        b = abitmapist.DayEvents('b', 2018, 1, 1)
+        today = abitmapist.DayEvents('a')
+
+        def make_events():
+            return [a, b, a & b, today, a | today]
+
+        assert await abitmapist.get_counts(make_events()) == [2, 1, 1, 1, 2]
+        assert await abitmapist.get_counts(make_events(), use_cache=True) == [
+            2, 1, 1, 1, 2
+        ]
+
+        # late marks invalidate cached counts of their events, unfinished
+        # counts are always fresh
+        await abitmapist.mark_events([('a', 3, datetime(2018, 1, 1)),
+                                      ('a', 3, None)])
+        assert await abitmapist.get_counts(make_events(), use_cache=True) == [
+            3, 1, 1, 2, 3
+        ]
+        await abitmapist.mark_event('b', 3, datetime(2018, 1, 1))
+        assert await abitmapist.get_counts(make_events(), use_cache=True) == [
+            3, 2, 1, 2, 3
+        ]
+        assert await abitmapist.get_counts([a]) == [3]
+        await abitmapist.count_cache.clear()
+        assert await abitmapist.get_counts([a], use_cache=True) == [3]
+
+    loop.run_until_complete(run())
+
+
+def test_count_series(abitmapist, loop):
+    async def run():
+        await abitmapist.mark_events([('active', 1, datetime(2018, 1, 1)),
+                                      ('active', 2, datetime(2018, 1, 1)),
+                                      ('active', 1, datetime(2018, 1, 3))])
+        series = await abitmapist.count_series('active', 'day',
+                                               datetime(2018, 1, 1),
+                                               datetime(2018, 1, 3))
+        assert series == [(datetime(2018, 1, 1), 2),
+                          (datetime(2018, 1, 2), 0),
+                          (datetime(2018, 1, 3), 1)]
+
+    loop.run_until_complete(run())
+
+
+def test_user_timeline(abitmapist, loop):
+    async def run():
+        await abitmapist.mark_events([('active', 1, datetime(2018, 1, 1)),
+                                      ('active', 1, datetime(2018, 1, 3)),
+                                      ('active', 2, datetime(2018, 1, 2))])
+        timeline = await abitmapist.user_timeline('active', 1, 'day',
+                                                  datetime(2018, 1, 1),
+                                                  datetime(2018, 1, 3))
+        assert timeline == [True, False, True]
+
+    loop.run_until_complete(run())
+
+
+def test_page(abitmapist, loop):
+    async def run():
+        uuids = [1, 2, 9, 100, 101, 5000, 5001, 5008, 1000000, 1000007]
+        await abitmapist.mark_events([('active', uuid, None)
+                                      for uuid in uuids] +
+                                     [('other', uuid * 2, None)
+                                      for uuid in uuids])
+        ev = abitmapist.DayEvents('active')
+        assert await ev.page(limit=3) == ([1, 2, 9], 9)
+        assert await ev.page(after_uuid=9, limit=3) == ([100, 101, 5000],
+                                                        5000)
+        assert await ev.page(after_uuid=5000, limit=5) == ([
+            5001, 5008, 1000000, 1000007
+        ], None)
+        assert await ev.page(after_uuid=1000007) == ([], None)
+
+        both = ev | abitmapist.DayEvents('other')
+        assert await both.page(after_uuid=4, limit=3) == ([9, 18, 100], 100)
+
+        # without GETRANGE, the whole bitmap is fetched
+        abitmapist._capabilities['getrange'] = False
+        await abitmapist.mark_events([('small', uuid, None)
+                                      for uuid in uuids[:5]])
+        small = abitmapist.DayEvents('small')
+        assert await small.page(after_uuid=2, limit=2) == ([9, 100], 100)
+        assert await small.page(after_uuid=100, limit=2) == ([101], None)
+
+    loop.run_until_complete(run())
+
+
+def test_contains_many(abitmapist, loop):
+    async def run():
+        await abitmapist.mark_events([('active', uuid, None)
+                                      for uuid in [1, 2, 9, 100, 5000]])
+        ev = abitmapist.DayEvents('active')
+        candidates = [0, 1, 2, 3, 100, 101, 5000, 20000]
+        expected = [False, True, True, False, True, False, True, False]
+        assert await ev.contains_many(candidates) == expected
+        assert await ev.contains_many(candidates, batch_size=3) == expected
+        assert await ev.contains_many(candidates,
+                                      fetch_threshold=1) == expected
+        assert await (ev | ev.prev()).contains_many(candidates) == expected
+        abitmapist._capabilities['bitfield'] = False
+        assert await ev.contains_many(candidates, batch_size=3) == expected
+
+    loop.run_until_complete(run())
+
+
+def test_unsupported_apis(abitmapist):
+    with pytest.raises(TypeError):
+        AsyncBitmapist(abitmapist.connection, use_scripting=True)
+    with pytest.raises(TypeError):
+        abitmapist.start_buffering()
+    assert abitmapist.writer is None
+    with pytest.raises(TypeError):
+        abitmapist.frequency([abitmapist.DayEvents('active')])
+
+
+def test_read_chunk_size(abitmapist, loop):
+    async def run():
+        abitmapist.read_chunk_size = 8
+        uuids = [1, 2, 9, 100, 101, 5000]
+        await abitmapist.mark_events([('active', uuid, None)
+                                      for uuid in uuids])
+        ev = abitmapist.DayEvents('active')
+        assert await collect(ev) == uuids
+        assert [uuid async for uuid in ev.get_uuids(chunk_size=1)] == uuids
+
+    loop.run_until_complete(run())
+
+
+def test_backfill_rollups(redis_server, loop):
+    async def run():
+        host, port = redis_server
+        conn = aioredis.StrictRedis(host=host, port=port)
+        b = AsyncBitmapist(conn, use_rollups=True)
+        try:
+            await b.mark_events([('active', 1, datetime(2017, month, 10))
+                                 for month in (2, 5, 8, 11)])
+            start, end = datetime(2017, 1, 1), datetime(2017, 12, 31)
+            assert await b.backfill_rollups(start, end) == 5
+            assert await conn.exists('bitmapist_active_Q2017-1')
+            assert await b.backfill_rollups(start, end) == 0
+            assert await b.YearEvents('active', 2017).get_count() == 1
+        finally:
+            await conn.connection_pool.disconnect()
+
+    try:
+        loop.run_until_complete(run())
+    finally:
+        flushall(redis.StrictRedis(*redis_server))
+
+
+def test_event_index_after_failed_mark(abitmapist, loop):
+    async def run():
+        await abitmapist.rebuild_event_index()
+        pipeline = abitmapist.connection.pipeline
+
+        def broken_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+
+            async def execute(*args, **kwargs):
+                raise aioredis.ConnectionError('Connection lost')
+
+            pipe.execute = execute
+            return pipe
+
+        abitmapist.connection.pipeline = broken_pipeline
+        with pytest.raises(aioredis.ConnectionError):
+            await abitmapist.mark_event('signup', 1)
+        del abitmapist.connection.pipeline
+        await abitmapist.mark_event('signup', 1)
+        assert await abitmapist.get_event_names() == ['signup']
+
+    loop.run_until_complete(run())
@@ -1,5 +1,8 @@
 from datetime import datetime, timedelta
 
+import pytest
+import redis
+
 
 def test_mark_with_diff_days(bitmapist):
     bitmapist.mark_event('active', 123)
@@ -188,6 +191,32 @@ def test_bitop_key_sharing(bitmapist):
     assert len(ev1_both) == len(ev1_both) == 0
 
 
+def test_delete_temporary_bitop_keys(bitmapist):
+    bitmapist.mark_event('foo', 1)
+    bitmapist.mark_event('bar', 2)
+    foo, bar = bitmapist.DayEvents('foo'), bitmapist.DayEvents('bar')
+    for ev in (foo & bar, foo | bar, foo ^ bar):
+        ev.materialize()
+    assert len(bitmapist.connection.keys('bitmapist_bitop_*')) == 3
+    assert bitmapist.delete_temporary_bitop_keys(batch_size=2) == 3
+    assert bitmapist.connection.keys('bitmapist_bitop_*') == []
+    assert 1 in foo
+
+
+def test_delete_all_events(bitmapist):
+    bitmapist.mark_events([('active', uuid, None) for uuid in range(10)])
+    bitmapist.mark_events([('signup', uuid, None) for uuid in range(10)])
+    total = len(bitmapist.connection.keys('bitmapist_*'))
+    progress = []
+    deleted = bitmapist.delete_all_events(
+        batch_size=3, pause=0.001, progress=progress.append)
+    assert deleted == total
+    assert progress[-1] == total
+    assert progress == sorted(progress)
+    assert bitmapist.connection.keys('bitmapist_*') == []
+    assert bitmapist.get_event_names() == []
+
+
 def test_events_marked(bitmapist):
     now = datetime.utcnow()
 
@@ -221,6 +250,117 @@ def test_get_event_names_prefix(bitmapist):
                                          batch=2)) == {'bar', 'baz'}
 
 
+def test_event_index(bitmapist, bitmapist_copy):
+    bitmapist.mark_event('song_played', 1)
+    bitmapist.mark_events([('song_liked', 1, None), ('active', 2, None)])
+    bitmapist.mark_unique('premium', 1)
+    with bitmapist.transaction():
+        bitmapist.mark_event('signup', 1)
+    index = bitmapist.connection.zrange('bitmapist_meta_events', 0, -1)
+    assert [name.decode() for name in index] == [
+        'active', 'premium', 'signup', 'song_liked', 'song_played'
+    ]
+    assert bitmapist_copy.get_event_names(prefix='song_') == [
+        'song_liked', 'song_played'
+    ]
+
+
+def test_event_index_is_sent_once(bitmapist):
+    bitmapist.mark_event('active', 1)
+    bitmapist.connection.delete('bitmapist_meta_events')
+    bitmapist.mark_event('active', 2)
+    assert not bitmapist.connection.exists('bitmapist_meta_events')
+    bitmapist.delete_all_events()
+    bitmapist.mark_event('active', 2)
+    assert bitmapist.connection.exists('bitmapist_meta_events')
+
+
+def test_rebuild_event_index(bitmapist):
+    bitmapist.connection.setbit('bitmapist_old_event_2018-1', 1, 1)
+    bitmapist.mark_event('active', 1)
+    # the index is incomplete until it's rebuilt
+    assert bitmapist.get_event_names() == ['active', 'old_event']
+    assert bitmapist.rebuild_event_index() == 2
+    assert bitmapist.get_event_names() == ['active', 'old_event']
+
+    # after the rebuild, names are read from the index
+    bitmapist.connection.setbit('bitmapist_unindexed_2018-1', 1, 1)
+    for name in ['song_liked', 'song_played', 'song_skipped', 'songs']:
+        bitmapist.mark_event(name, 1)
+    assert bitmapist.get_event_names(batch=2) == [
+        'active', 'old_event', 'song_liked', 'song_played', 'song_skipped',
+        'songs'
+    ]
+    assert bitmapist.get_event_names(prefix='song_', batch=2) == [
+        'song_liked', 'song_played', 'song_skipped'
+    ]
+    assert bitmapist.get_event_names(prefix='x') == []
+
+    # deleted events invalidate the index
+    bitmapist.delete_all_events()
+    bitmapist.connection.setbit('bitmapist_old_event_2018-1', 1, 1)
+    bitmapist.mark_event('active', 1)
+    assert bitmapist.get_event_names() == ['active', 'old_event']
+
+
+def test_rebuild_keeps_names_indexed_meanwhile(bitmapist, bitmapist_copy,
+                                               monkeypatch):
+    bitmapist.connection.setbit('bitmapist_old_2018-1', 1, 1)
+    scan = bitmapist._scan_event_names
+
+    def scan_and_mark(prefix, batch):
+        names = scan(prefix, batch)
+        # another process marks a new event while the keys are scanned
+        bitmapist_copy.mark_event('signup', 1)
+        return names
+
+    monkeypatch.setattr(bitmapist, '_scan_event_names', scan_and_mark)
+    assert bitmapist.rebuild_event_index() == 1
+    assert bitmapist.get_event_names() == ['old', 'signup']
+
+
+def break_pipelines(bitmapist, monkeypatch):
+    """
+    Make pipelines of the bitmapist object fail on execution
+    """
+    pipeline = bitmapist.connection.pipeline
+
+    def broken_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+
+        def execute(*args, **kwargs):
+            raise redis.ConnectionError('Connection lost')
+
+        pipe.execute = execute
+        return pipe
+
+    monkeypatch.setattr(bitmapist.connection, 'pipeline', broken_pipeline)
+
+
+@pytest.mark.parametrize('mark', [
+    lambda b: b.mark_event('signup', 1),
+    lambda b: b.mark_events([('signup', 1, None)]),
+])
+def test_event_index_after_failed_mark(bitmapist, monkeypatch, mark):
+    bitmapist.rebuild_event_index()
+    with monkeypatch.context() as m:
+        break_pipelines(bitmapist, m)
+        with pytest.raises(redis.ConnectionError):
+            mark(bitmapist)
+    mark(bitmapist)
+    assert bitmapist.get_event_names() == ['signup']
+
+
+def test_event_index_after_rollback(bitmapist):
+    bitmapist.rebuild_event_index()
+    with pytest.raises(ValueError):
+        with bitmapist.transaction():
+            bitmapist.mark_event('signup', 1)
+            raise ValueError()
+    bitmapist.mark_event('signup', 1)
+    assert bitmapist.get_event_names() == ['signup']
+
+
 def test_bit_operations_magic(bitmapist):
     bitmapist.mark_event('foo', 1)
     bitmapist.mark_event('foo', 2)
@@ -237,3 +377,195 @@ def test_bit_operations_magic(bitmapist):
 def test_year_events(bitmapist):
     bitmapist.mark_event('foo', 1)
     assert 1 in bitmapist.YearEvents('foo')
+
+
+def test_mark_events(bitmapist):
+    now = datetime.utcnow()
+    yesterday = now - timedelta(days=1)
+    bitmapist.mark_events([
+        ('active', 1, now),
+        ('active', 2, None),
+        ('active', 3, yesterday),
+        ('song:played', 1, now),
+    ])
+    assert list(bitmapist.DayEvents.from_date('active', now)) == [1, 2]
+    assert list(bitmapist.DayEvents.from_date('active', yesterday)) == [3]
+    assert list(bitmapist.HourEvents.from_date('song:played', now)) == [1]
+    assert list(bitmapist.UniqueEvents('active')) == [1, 2, 3]
+
+
+def test_mark_events_batches(bitmapist):
+    events = [('active', uuid, None) for uuid in range(100)]
+    bitmapist.mark_events(events, batch_size=7)
+    assert list(bitmapist.WeekEvents('active')) == list(range(100))
+
+    bitmapist.unmark_events(events[:50], batch_size=7)
+    assert list(bitmapist.WeekEvents('active')) == list(range(50, 100))
+
+
+def test_mark_events_transaction(bitmapist):
+    with bitmapist.transaction():
+        bitmapist.mark_events([('active', 1, None), ('active', 2, None)])
+        assert len(bitmapist.DayEvents('active')) == 0
+    assert len(bitmapist.DayEvents('active')) == 2
+
+
+def test_mark_keys_cache(bitmapist):
+    now = datetime(2018, 12, 31, 13, 20)
+    keys = bitmapist._mark_keys('active', now, True, True)
+    assert keys == (
+        bitmapist.MonthEvents.from_date('active', now).redis_key,
+        bitmapist.WeekEvents.from_date('active', now).redis_key,
+        bitmapist.DayEvents.from_date('active', now).redis_key,
+        bitmapist.HourEvents.from_date('active', now).redis_key,
+        bitmapist.UniqueEvents('active').redis_key,
+    )
+    assert bitmapist._mark_keys('active', now.replace(minute=59), True,
+                                True) is keys
+    assert len(bitmapist._mark_keys('active', now, False, False)) == 3
+
+    bitmapist._mark_keys_cache.maxsize = 10
+    for hour in range(24):
+        bitmapist._mark_keys('active', now.replace(hour=hour), True, True)
+    assert len(bitmapist._mark_keys_cache) == 10
+
+
+def test_get_uuids_chunked(bitmapist):
+    uuids = [1, 2, 9, 100, 101, 5000, 5001, 5008, 1000000, 1000007]
+    for uuid in uuids:
+        bitmapist.mark_event('active', uuid)
+    ev = bitmapist.DayEvents('active')
+    assert list(ev.get_uuids()) == uuids
+    for chunk_size in [1, 2, 3, 100, 1000000]:
+        assert list(ev.get_uuids(chunk_size=chunk_size)) == uuids
+    assert list(bitmapist.DayEvents('unknown').get_uuids(chunk_size=1)) == []
+
+    bitmapist.read_chunk_size = 16
+    assert list(ev) == uuids
+    assert list(ev & bitmapist.HourEvents('active')) == uuids
+
+
+def test_page(bitmapist):
+    uuids = [1, 2, 9, 100, 101, 5000, 5001, 5008, 1000000, 1000007]
+    for uuid in uuids:
+        bitmapist.mark_event('active', uuid)
+        bitmapist.mark_event('other', uuid * 2)
+    ev = bitmapist.DayEvents('active')
+
+    assert ev.page(limit=3) == ([1, 2, 9], 9)
+    assert ev.page(after_uuid=9, limit=3) == ([100, 101, 5000], 5000)
+    assert ev.page(after_uuid=5000, limit=5) == ([5001, 5008, 1000000,
+                                                  1000007], None)
+    assert ev.page(after_uuid=1000007) == ([], None)
+
+    pages, cursor = [], None
+    while True:
+        page, cursor = ev.page(after_uuid=cursor, limit=2)
+        pages.extend(page)
+        if cursor is None:
+            break
+    assert pages == uuids
+
+    both = ev | bitmapist.DayEvents('other')
+    assert both.page(after_uuid=4, limit=3) == ([9, 18, 100], 100)
+
+
+def test_contains_many(bitmapist):
+    uuids = [1, 2, 9, 100, 5000, 1000007]
+    for uuid in uuids:
+        bitmapist.mark_event('active', uuid)
+    ev = bitmapist.DayEvents('active')
+    candidates = [0, 1, 2, 3, 100, 101, 1000007, 2000000]
+    expected = [False, True, True, False, True, False, True, False]
+
+    assert ev.contains_many(candidates) == expected
+    assert ev.contains_many(candidates, batch_size=3) == expected
+    assert ev.contains_many(candidates, fetch_threshold=1) == expected
+    assert ev.contains_many([]) == []
+    assert bitmapist.DayEvents('unknown').contains_many(
+        candidates, fetch_threshold=1) == [False] * len(candidates)
+
+
+def test_user_timeline(bitmapist):
+    start = datetime(2018, 12, 30, 22)
+    bitmapist.mark_event('active', 1, timestamp=start)
+    bitmapist.mark_event('active', 1, timestamp=start + timedelta(days=2))
+    bitmapist.mark_event('active', 2, timestamp=start + timedelta(days=1))
+    end = start + timedelta(days=3)
+
+    assert bitmapist.user_timeline('active', 1, 'day', start, end) == [
+        True, False, True, False
+    ]
+    assert bitmapist.user_timeline('active', 1, 'week', start, end) == [
+        True, True
+    ]
+    assert bitmapist.user_timeline('active', 1, 'month', start, end) == [
+        True, True
+    ]
+    hours = bitmapist.user_timeline('active', 1, 'hour', start,
+                                    start + timedelta(hours=3))
+    assert hours == [True, False, False, False]
+    assert bitmapist.user_timeline('active', 3, 'day', start, end) == [
+        False
+    ] * 4
+    with pytest.raises(ValueError):
+        bitmapist.user_timeline('active', 1, 'decade', start, end)
+
+
+def test_get_counts(bitmapist):
+    bitmapist.mark_event('foo', 1)
+    bitmapist.mark_event('foo', 2)
+    bitmapist.mark_event('bar', 2)
+    foo = bitmapist.DayEvents('foo')
+    bar = bitmapist.DayEvents('bar')
+    events = [foo, bar, foo.prev(), foo & bar, foo | bar, foo,
+              bitmapist.YearEvents('foo')]
+    assert bitmapist.get_counts(events) == [len(ev) for ev in events]
+    assert bitmapist.get_counts(events) == [2, 1, 0, 1, 2, 2, 2]
+    assert bitmapist.get_counts([]) == []
+
+
+def test_count_series(bitmapist):
+    now = datetime.utcnow()
+    start = now - timedelta(days=3)
+    bitmapist.mark_event('active', 1, timestamp=start)
+    bitmapist.mark_event('active', 2, timestamp=start)
+    bitmapist.mark_event('active', 1, timestamp=now)
+    day = bitmapist.DayEvents.from_date('active', start)
+
+    series = bitmapist.count_series('active', 'day', start)
+    assert series == [(day.period_start(), 2),
+                      (day.next().period_start(), 0),
+                      (day.delta(2).period_start(), 0),
+                      (day.delta(3).period_start(), 1)]
+
+    # late marks invalidate cached counts of finished periods
+    bitmapist.mark_event('active', 3, timestamp=start)
+    bitmapist.mark_events([('active', 4, start + timedelta(days=1)),
+                           ('active', 3, now)])
+    counts = [count for _, count in bitmapist.count_series('active', 'day',
+                                                           start)]
+    assert counts == [3, 1, 0, 2]
+
+    # other changes of finished periods need the cache to be cleared
+    bitmapist.connection.setbit(day.redis_key, 5, 1)
+    counts = [count for _, count in bitmapist.count_series('active', 'day',
+                                                           start)]
+    assert counts == [3, 1, 0, 2]
+    bitmapist.count_cache.clear()
+    counts = [count for _, count in bitmapist.count_series('active', 'day',
+                                                           start)]
+    assert counts == [4, 1, 0, 2]
+
+
+def test_count_series_in_process_memory(bitmapist):
+    bitmapist._capabilities['hash'] = False
+    test_count_series(bitmapist)
+    assert not bitmapist.connection.exists('bitmapist_meta_counts')
+
+
+def test_count_cache_is_not_an_event(bitmapist):
+    bitmapist.mark_event('active', 1, timestamp=datetime(2018, 1, 1))
+    bitmapist.count_series('active', 'month', datetime(2018, 1, 1),
+                           datetime(2018, 2, 1))
+    assert bitmapist.get_event_names() == ['active']
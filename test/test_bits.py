@@ -0,0 +1,64 @@
+import random
+
+import pytest
+
+from bitmapist4 import bits
+
+
+def reference_set_bits(data, offset=0):
+    return [
+        offset + char_num * 8 + bit
+        for char_num, char in enumerate(bytearray(data))
+        for bit in range(8) if char & (0x80 >> bit)
+    ]
+
+
+def random_bitmap(size, density):
+    return bytes(
+        bytearray(
+            sum(0x80 >> bit for bit in range(8) if random.random() < density)
+            for _ in range(size)))
+
+
+decoders = [bits._iter_set_bits_words]
+if bits.np is not None:
+    decoders.append(bits._iter_set_bits_numpy)
+
+
+@pytest.mark.parametrize('decoder', decoders)
+@pytest.mark.parametrize('size', [0, 1, 7, 8, 9, 100])
+@pytest.mark.parametrize('density', [0, 0.01, 0.5, 1])
+def test_iter_set_bits(decoder, size, density):
+    data = random_bitmap(size, density)
+    assert list(decoder(data, 0)) == reference_set_bits(data)
+    assert list(decoder(data, 80)) == reference_set_bits(data, 80)
+
+
+@pytest.mark.parametrize('decoder', decoders)
+def test_iter_set_bits_chunks(decoder, monkeypatch):
+    monkeypatch.setattr(bits, 'CHUNK_SIZE', 16)
+    data = random_bitmap(100, 0.1)
+    assert list(decoder(data, 0)) == reference_set_bits(data)
+
+
+def test_get_bits():
+    data = random_bitmap(10, 0.3)
+    set_bits = set(reference_set_bits(data))
+    offsets = list(range(100))
+    random.shuffle(offsets)
+    assert bits.get_bits(data, offsets) == [
+        offset in set_bits for offset in offsets
+    ]
+    assert bits.get_bits(b'', [0, 7]) == [False, False]
+
+
+@pytest.mark.skipif(bits.np is None, reason='NumPy is not installed')
+def test_count_bits():
+    bitmaps = [random_bitmap(size, 0.3) for size in (0, 1, 9, 100)]
+    matrix = bits.to_matrix(bitmaps)
+    assert matrix.shape == (4, 100)
+    assert bits.count_bits(matrix).tolist() == [
+        len(reference_set_bits(data)) for data in bitmaps
+    ]
+    # the lookup table, used with NumPy < 2.0
+    assert (bits.POPCOUNT[matrix].sum(axis=1) == bits.count_bits(matrix)).all()
@@ -0,0 +1,88 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+START = datetime(2018, 3, 1)
+
+
+@pytest.fixture
+def days(bitmapist):
+    # uuid n is active on the first n days
+    bitmapist.mark_events([('active', uuid, START + timedelta(days=day))
+                           for uuid in range(12) for day in range(uuid)])
+    return [bitmapist.DayEvents.from_date('active', START).delta(i)
+            for i in range(11)]
+
+
+def test_planes(bitmapist, days):
+    freq = bitmapist.frequency(days)
+    assert len(freq.planes) == 4
+    assert [freq.get(uuid) for uuid in range(13)] == list(range(12)) + [0]
+
+
+def test_at_least(bitmapist, days):
+    freq = bitmapist.frequency(days)
+    for n in range(1, 12):
+        assert list(freq.at_least(n)) == list(range(n, 12)), n
+    assert list(freq.at_least(12)) == []
+    with pytest.raises(ValueError):
+        freq.at_least(0)
+
+
+def test_exactly_and_between(bitmapist, days):
+    freq = bitmapist.frequency(days)
+    for n in range(1, 12):
+        assert list(freq.exactly(n)) == [n]
+    assert list(freq.between(3, 5)) == [3, 4, 5]
+    assert list(freq.between(9, 20)) == [9, 10, 11]
+    assert freq.histogram() == [1] * 11
+
+
+def test_single_event(bitmapist, days):
+    freq = bitmapist.frequency(days[-1:])
+    assert list(freq.at_least(1)) == [11]
+    assert list(freq.exactly(1)) == [11]
+    assert list(freq.at_least(2)) == []
+
+
+def test_combined_with_events(bitmapist, days):
+    bitmapist.mark_unique('premium', 4)
+    bitmapist.mark_unique('premium', 8)
+    freq = bitmapist.frequency(days)
+    assert list(freq.at_least(5) & bitmapist.UniqueEvents('premium')) == [8]
+
+
+def test_delta(bitmapist, days):
+    freq = bitmapist.frequency(days[:5]).delta(5)
+    # days 5..9: uuid n is active on n - 5 of them
+    assert list(freq.exactly(2)) == [7]
+    assert list(freq.at_least(5)) == [10, 11]
+
+
+def test_digest_keys(bitmapist, days):
+    freq = bitmapist.frequency(days)
+    ev = freq.at_least(6)
+    steps = bitmapist._queue_plan(bitmapist.connection.pipeline(), [ev])
+    slices = [step for step in steps
+              if isinstance(step.op, bitmapist.SliceOperation)]
+    assert slices
+    assert all(len(step.redis_key) < 64 for step in slices)
+
+
+@pytest.mark.parametrize('n_days', [30, 60])
+def test_many_events(bitmapist, n_days):
+    # operations of the adder share operands, make sure they're not walked
+    # recursively
+    bitmapist.mark_events([('active', uuid, START + timedelta(days=day))
+                           for uuid in range(5) for day in range(uuid * 3)])
+    days = [bitmapist.DayEvents.from_date('active', START).delta(i)
+            for i in range(n_days)]
+    started = time.time()
+    freq = bitmapist.frequency(days)
+    ev = freq.at_least(3)
+    assert ev.event_finished()
+    assert list(ev) == [1, 2, 3, 4]
+    assert list(ev.delta(0)) == [1, 2, 3, 4]
+    assert repr(ev).startswith('SliceOperation(')
+    assert time.time() - started < 10
@@ -0,0 +1,182 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from bitmapist4.cohort import get_cohort_row, get_cohort_table
+
+
+@pytest.fixture
+def marked(bitmapist):
+    # users register over 6 weeks, and stay active for a few weeks after
+    now = datetime.utcnow()
+    events = []
+    for uuid in range(30):
+        registered = now - timedelta(weeks=uuid % 6)
+        events.append(('registered', uuid, registered))
+        for week in range(uuid % 4):
+            events.append(('active', uuid, registered + timedelta(weeks=week)))
+    bitmapist.mark_events([e for e in events if e[2] <= now])
+    return bitmapist
+
+
+def reference_row(cohort, activity, cols, use_percent):
+    # the straightforward computation, a cell at a time
+    now = datetime.utcnow()
+    size = len(cohort)
+    cells = []
+    for offset in range(cols):
+        current = activity.delta(offset)
+        if current.period_start() >= now:
+            break
+        affected = len(cohort & current)
+        if use_percent:
+            affected = affected * 100.0 / size if size else 0
+        cells.append(affected)
+    return size, cells
+
+
+@pytest.mark.parametrize('backend', ['redis', 'numpy'])
+@pytest.mark.parametrize('use_percent', [True, False])
+def test_cohort_table(marked, use_percent, backend):
+    if backend == 'numpy':
+        pytest.importorskip('numpy')
+    b = marked
+    cohort, activity = b.WeekEvents('registered'), b.WeekEvents('active')
+    table = get_cohort_table(cohort, activity, rows=8, cols=5,
+                             use_percent=use_percent, backend=backend)
+    assert len(table.rows) == 8
+    for offset, row in enumerate(reversed(table.rows)):
+        size, cells = reference_row(cohort.delta(-offset),
+                                    activity.delta(-offset), 5, use_percent)
+        assert row.name == cohort.delta(-offset).period_start().strftime(
+            '%d %b %Y')
+        assert (row.size, row.cells) == (size, cells)
+    assert table.rows[-1].cells == [40.0 if use_percent else 2]
+
+
+@pytest.mark.parametrize('backend', ['redis', 'numpy'])
+@pytest.mark.parametrize('workers', [2, 3, 20])
+def test_cohort_table_workers(marked, backend, workers):
+    if backend == 'numpy':
+        pytest.importorskip('numpy')
+    b = marked
+    cohort, activity = b.WeekEvents('registered'), b.WeekEvents('active')
+    expected = get_cohort_table(cohort, activity, rows=7, cols=5)
+    table = get_cohort_table(cohort, activity, rows=7, cols=5,
+                             backend=backend, workers=workers)
+    assert repr(table) == repr(expected)
+
+
+def test_numpy_workers_fetch_bitmaps_once(marked, monkeypatch):
+    pytest.importorskip('numpy')
+    from bitmapist4 import cohort as cohort_module
+    b = marked
+    fetches = []
+    fetch = cohort_module._fetch_counts_numpy
+
+    def counting_fetch(*args):
+        fetches.append(args)
+        return fetch(*args)
+
+    monkeypatch.setattr(cohort_module, '_fetch_counts_numpy', counting_fetch)
+    get_cohort_table(b.WeekEvents('registered'), b.WeekEvents('active'),
+                     rows=7, cols=5, backend='numpy', workers=3)
+    assert len(fetches) == 1
+
+
+def test_workers_share_bitop_cache_stats(marked):
+    b = marked
+    cohort, activity = b.WeekEvents('registered'), b.WeekEvents('active')
+    get_cohort_table(cohort, activity, rows=7, cols=5, workers=4)
+    # a cell per started activity period of every row
+    cells = sum(min(5, offset + 1) for offset in range(7))
+    assert b.bitop_cache_stats == {'hits': 0, 'misses': cells}
+
+
+def test_cohort_row(marked):
+    b = marked
+    cohort, activity = b.WeekEvents('registered'), b.WeekEvents('active')
+    row = get_cohort_row(cohort.prev(), activity.prev(), 4)
+    assert (row.size, row.cells) == reference_row(cohort.prev(),
+                                                  activity.prev(), 4, True)
+
+
+def test_cohort_table_pipelines(marked, monkeypatch):
+    b = marked
+    pipelines = []
+    pipeline = b.connection.pipeline
+
+    def counting_pipeline(*args, **kwargs):
+        pipelines.append(1)
+        return pipeline(*args, **kwargs)
+
+    monkeypatch.setattr(b.connection, 'pipeline', counting_pipeline)
+    get_cohort_table(b.WeekEvents('registered'), b.WeekEvents('active'),
+                     rows=10)
+    # the existence check of finished operations, and the plan itself
+    assert len(pipelines) <= 2
+
+
+def test_cohort_table_numpy(marked):
+    pytest.importorskip('numpy')
+    b = marked
+    cohort, activity = b.MonthEvents('registered'), b.DayEvents('active')
+    expected = get_cohort_table(cohort, activity, rows=3, cols=40)
+    keys = set(b.connection.keys('bitmapist_*'))
+    table = get_cohort_table(cohort, activity, rows=3, cols=40,
+                             backend='numpy')
+    assert repr(table) == repr(expected)
+    # no temporary keys are written
+    assert set(b.connection.keys('bitmapist_*')) == keys
+
+
+def test_cohort_row_numpy(marked):
+    pytest.importorskip('numpy')
+    b = marked
+    cohort, activity = b.WeekEvents('registered'), b.WeekEvents('active')
+    row = get_cohort_row(cohort.prev(), activity.prev(), 4, backend='numpy')
+    assert (row.size, row.cells) == reference_row(cohort.prev(),
+                                                  activity.prev(), 4, True)
+
+
+def test_unknown_backend(bitmapist):
+    with pytest.raises(ValueError):
+        get_cohort_table(bitmapist.WeekEvents('registered'),
+                         bitmapist.WeekEvents('active'), backend='spark')
+
+
+@pytest.mark.parametrize('backend', ['redis', 'numpy'])
+def test_cohort_table_cache(marked, backend):
+    if backend == 'numpy':
+        pytest.importorskip('numpy')
+    b = marked
+    cohort, activity = b.WeekEvents('registered'), b.WeekEvents('active')
+    expected = get_cohort_table(cohort, activity, rows=6)
+    table = get_cohort_table(cohort, activity, rows=6, backend=backend,
+                             use_cache=True)
+    assert repr(table) == repr(expected)
+
+    # 5 finished cohorts, and 15 finished cells out of 21
+    cached = b.count_cache.get_many(list(
+        b.connection.hkeys('bitmapist_meta_counts')))
+    assert len(cached) == 20
+
+    # cached counts are used as is
+    finished_cell = cohort.prev() & activity.prev()
+    b.count_cache.set_many({finished_cell.redis_key: 100})
+    table = get_cohort_table(cohort, activity, rows=6, backend=backend,
+                             use_cache=True)
+    assert table.rows[-2].size == expected.rows[-2].size
+    assert table.rows[-2].cells[0] == 100 * 100.0 / expected.rows[-2].size
+    assert table.rows[-2].cells[1] == expected.rows[-2].cells[1]
+
+
+def test_cohort_table_cache_is_shared(marked):
+    pytest.importorskip('numpy')
+    b = marked
+    cohort, activity = b.WeekEvents('registered'), b.WeekEvents('active')
+    get_cohort_table(cohort, activity, rows=6, use_cache=True)
+    redis_keys = b.connection.hkeys('bitmapist_meta_counts')
+    get_cohort_table(cohort, activity, rows=6, backend='numpy',
+                     use_cache=True)
+    assert b.connection.hkeys('bitmapist_meta_counts') == redis_keys
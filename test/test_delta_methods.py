@@ -36,3 +36,11 @@ def test_delta_year(bitmapist):
     assert n.year == 2015
     p = ev.prev()
     assert p.year == 2013
+
+
+def test_delta_quarter(bitmapist):
+    ev = bitmapist.QuarterEvents('foo', 2014, 1)
+    n = ev.next()
+    assert (n.year, n.quarter) == (2014, 2)
+    p = ev.prev()
+    assert (p.year, p.quarter) == (2013, 4)
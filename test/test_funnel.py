@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from bitmapist4.funnel import get_funnel
+
+NOW = datetime.utcnow()
+
+
+@pytest.fixture
+def marked(bitmapist):
+    last_week = NOW - timedelta(weeks=1)
+    bitmapist.mark_events(
+        [('signup', uuid, last_week) for uuid in range(10)] +
+        [('project', uuid, last_week) for uuid in range(6)] +
+        [('project', uuid, NOW) for uuid in (6, 7, 20)] +
+        [('invite', uuid, last_week) for uuid in (0, 1, 7, 21)] +
+        [('invite', uuid, NOW) for uuid in (2, 6)])
+    return bitmapist
+
+
+def test_funnel(marked):
+    b = marked
+    funnel = get_funnel([
+        b.WeekEvents('signup').prev(),
+        b.WeekEvents('project').prev(),
+        b.WeekEvents('invite').prev(),
+    ])
+    assert [step.name for step in funnel.steps] == [
+        'signup', 'project', 'invite'
+    ]
+    assert [step.count for step in funnel.steps] == [10, 6, 2]
+    assert [step.conversion for step in funnel.steps] == [
+        100.0, 60.0, 2 * 100.0 / 6
+    ]
+    assert [step.total_conversion for step in funnel.steps] == [
+        100.0, 60.0, 20.0
+    ]
+
+
+def test_funnel_window(marked):
+    b = marked
+    funnel = get_funnel([
+        b.WeekEvents('signup').prev(),
+        b.WeekEvents('project').prev(),
+        b.WeekEvents('invite').prev(),
+    ], window=1)
+    # 0..7 created a project, 0, 1, 2, 6 and 7 invited a teammate
+    assert [step.count for step in funnel.steps] == [10, 8, 5]
+
+
+def test_funnel_reuses_steps(marked, monkeypatch):
+    b = marked
+    plans = []
+    queue_plan = b._queue_plan
+
+    def recording_queue_plan(pipe, events):
+        steps = queue_plan(pipe, events)
+        plans.append(steps)
+        return steps
+
+    monkeypatch.setattr(b, '_queue_plan', recording_queue_plan)
+    get_funnel([b.WeekEvents(name).prev()
+                for name in ('signup', 'project', 'invite', 'upgrade')])
+    # a single plan, where every step ANDs the previous step and its event
+    [plan] = plans
+    assert [step.op_name for step in plan] == ['AND'] * 3
+    assert [len(step.source_keys) for step in plan] == [2, 2, 2]
+    assert plan[1].source_keys[0] == plan[0].redis_key
+    assert plan[2].source_keys[0] == plan[1].redis_key
+
+
+def test_funnel_empty(bitmapist):
+    funnel = get_funnel([bitmapist.WeekEvents('signup'),
+                         bitmapist.WeekEvents('project')])
+    assert [(step.count, step.conversion) for step in funnel.steps] == [
+        (0, 0), (0, 0)
+    ]
+    with pytest.raises(ValueError):
+        get_funnel([])
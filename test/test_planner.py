@@ -0,0 +1,157 @@
+from datetime import datetime
+
+import bitmapist4
+from bitmapist4 import planner
+
+
+def keys(b, *names):
+    return [b.DayEvents(name).redis_key for name in names]
+
+
+def test_lazy_bit_operations(bitmapist):
+    bitmapist.mark_event('foo', 1)
+    op = bitmapist.DayEvents('foo') & bitmapist.DayEvents('bar')
+    assert not bitmapist.connection.exists(op.redis_key)
+    assert op.materialize() is op
+    assert bitmapist.connection.exists(op.redis_key)
+    assert bitmapist.connection.ttl(op.redis_key) > 0
+
+
+def test_plan_flattens_same_type_ops(bitmapist):
+    a, b, c, d = [bitmapist.DayEvents(name) for name in 'abcd']
+    op = ((a & b) & c) & d
+    steps = planner.plan([op])
+    assert len(steps) == 1
+    assert steps[0].redis_key == op.redis_key
+    assert steps[0].source_keys == keys(bitmapist, 'a', 'b', 'c', 'd')
+
+
+def test_plan_keeps_different_ops(bitmapist):
+    a, b, c = [bitmapist.DayEvents(name) for name in 'abc']
+    op = (a | b) & c
+    steps = planner.plan([op])
+    assert [step.op_name for step in steps] == ['OR', 'AND']
+    assert steps[1].source_keys == [steps[0].redis_key, c.redis_key]
+
+
+def test_plan_common_subexpressions(bitmapist):
+    a, b, c = [bitmapist.DayEvents(name) for name in 'abc']
+    op = ((a & b) | c) ^ ((a & b) | c)
+    steps = planner.plan([op])
+    assert [step.op_name for step in steps] == ['AND', 'OR', 'XOR']
+    or_key = steps[1].redis_key
+    assert steps[2].source_keys == [or_key, or_key]
+
+
+def test_plan_shared_and_requested_ops(bitmapist):
+    a, b, c = [bitmapist.DayEvents(name) for name in 'abc']
+    ab = a & b
+    abc = ab & c
+    steps = planner.plan([ab, abc])
+    assert [step.redis_key for step in steps] == [ab.redis_key, abc.redis_key]
+    assert steps[1].source_keys == [ab.redis_key, c.redis_key]
+
+
+def test_plan_removes_duplicates(bitmapist):
+    a, b = bitmapist.DayEvents('a'), bitmapist.DayEvents('b')
+    steps = planner.plan([(a | b) | a])
+    assert steps[0].source_keys == keys(bitmapist, 'a', 'b')
+    steps = planner.plan([(a ^ b) ^ a])
+    assert steps[0].source_keys == keys(bitmapist, 'a', 'b', 'a')
+
+
+def test_plan_skips_materialized(bitmapist):
+    a, b, c = [bitmapist.DayEvents(name) for name in 'abc']
+    ab = (a & b).materialize()
+    steps = planner.plan([ab & c, ab])
+    assert len(steps) == 1
+    assert steps[0].source_keys == [ab.redis_key, c.redis_key]
+
+
+def test_complex_expression(bitmapist):
+    for uuid in [1, 2, 3, 4]:
+        bitmapist.mark_event('a', uuid)
+    for uuid in [2, 3]:
+        bitmapist.mark_event('b', uuid)
+    for uuid in [4, 5]:
+        bitmapist.mark_event('c', uuid)
+    a, b, c = [bitmapist.DayEvents(name) for name in 'abc']
+    op = (a & b) | (a & c)
+    assert list(op) == [2, 3, 4]
+    assert bitmapist.get_counts([op, (a & b) & c, (a | b) | c,
+                                 bitmapist.YearEvents('a') | c]) == [3, 0, 5, 5]
+
+
+def test_finished_ops_reuse_existing_keys(bitmapist):
+    bitmapist.mark_event('a', 1, timestamp=datetime(2018, 1, 1))
+    bitmapist.mark_event('b', 1, timestamp=datetime(2018, 1, 1))
+    a = bitmapist.DayEvents('a', 2018, 1, 1)
+    b = bitmapist.DayEvents('b', 2018, 1, 1)
+    assert len(a & b) == 1
+    assert bitmapist.bitop_cache_stats == {'hits': 0, 'misses': 1}
+
+    # the result of the finished operation can't change, reuse it
+    bitmapist.mark_event('b', 2, timestamp=datetime(2018, 1, 1))
+    assert len(a | b) == 2
+    assert len(a & b) == 1
+    assert bitmapist.get_counts([a & b]) == [1]
+    assert bitmapist.bitop_cache_stats == {'hits': 2, 'misses': 2}
+
+    # unfinished operations are always recomputed
+    today_a = bitmapist.DayEvents('a')
+    assert len(today_a & today_a) == 0
+    bitmapist.mark_event('a', 1)
+    assert len(today_a & today_a) == 1
+    assert bitmapist.bitop_cache_stats == {'hits': 2, 'misses': 4}
+
+
+def test_finished_ops_reuse_without_scripting(bitmapist):
+    bitmapist._capabilities['scripting'] = False
+    test_finished_ops_reuse_existing_keys(bitmapist)
+
+
+def test_snapshots_of_unfinished_ops_are_not_reused(bitmapist):
+    bitmapist.mark_event('a', 1, timestamp=datetime(2018, 1, 1))
+    bitmapist.mark_event('b', 1, timestamp=datetime(2018, 1, 1))
+    def make_op():
+        return (bitmapist.DayEvents('a', 2018, 1, 1) &
+                bitmapist.DayEvents('b', 2018, 1, 1))
+
+    op = make_op()
+    op.materialize()
+    # the key looks like it was written while the day was still open
+    bitmapist.connection.expire(op.redis_key, bitmapist.unfinished_ops_expire)
+    bitmapist.mark_event('a', 2, timestamp=datetime(2018, 1, 1))
+    bitmapist.mark_event('b', 2, timestamp=datetime(2018, 1, 1))
+    op = make_op()
+    assert bitmapist.get_counts([op], use_cache=True) == [2]
+    assert bitmapist.get_counts([make_op()], use_cache=True) == [2]
+    assert bitmapist.bitop_cache_stats == {'hits': 0, 'misses': 2}
+    assert bitmapist.connection.ttl(
+        op.redis_key) > bitmapist.unfinished_ops_expire
+
+
+def test_snapshots_of_unfinished_ops_without_scripting(bitmapist):
+    bitmapist._capabilities['scripting'] = False
+    test_snapshots_of_unfinished_ops_are_not_reused(bitmapist)
+
+
+def test_hashed_bitop_keys(bitmapist):
+    b = bitmapist4.Bitmapist(bitmapist.connection, hash_bitop_keys=True,
+                             record_bitop_expressions=True)
+    b.mark_event('a', 1)
+    b.mark_event('b', 1)
+    b.mark_event('b', 2)
+    year_a, year_b = b.YearEvents('a'), b.YearEvents('b')
+    op = (year_a & year_b) | (year_a ^ year_b)
+    assert len(op.redis_key) == len(b.YearEvents('foo').redis_key)
+    assert (year_a & year_b).redis_key == (year_b & year_a).redis_key
+    assert (~year_a).redis_key != (~year_b).redis_key
+    assert list(op) == [1, 2]
+
+    expression = b.connection.get(b.bitop_expression_key(op.redis_key))
+    and_op = year_a & year_b
+    xor_op = year_a ^ year_b
+    assert expression.decode() == 'OR({})'.format(' '.join(
+        sorted([and_op.redis_key, xor_op.redis_key])))
+    assert b.get_event_names() == ['a', 'b']
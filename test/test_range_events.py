@@ -0,0 +1,92 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+
+
+def kinds(ev):
+    return [part.__class__.__name__ for part in ev.parts]
+
+
+def test_range_cover(bitmapist):
+    ev = bitmapist.RangeEvents('active', date(2018, 3, 3), date(2018, 4, 19))
+    assert kinds(ev) == ['DayEvents'] * 2 + ['WeekEvents'] * 6 + [
+        'DayEvents'
+    ] * 4
+    ev = bitmapist.RangeEvents('active', date(2018, 1, 29), date(2018, 4, 1))
+    assert kinds(ev) == ['DayEvents'] * 3 + ['MonthEvents'] * 2 + [
+        'DayEvents'
+    ]
+    ev = bitmapist.RangeEvents('active', date(2018, 2, 1), date(2018, 2, 28))
+    assert kinds(ev) == ['MonthEvents']
+    # weeks are better than the month of February and the days around it
+    ev = bitmapist.RangeEvents('active', date(2018, 1, 29), date(2018, 3, 4))
+    assert kinds(ev) == ['WeekEvents'] * 5
+    ev = bitmapist.RangeEvents('active', date(2018, 1, 3), date(2018, 4, 19))
+    assert len(ev.parts) == 20
+
+
+def test_range_hourly_cover(bitmapist):
+    ev = bitmapist.RangeEvents(
+        'active', datetime(2018, 3, 3, 22), datetime(2018, 3, 5, 1),
+        hourly=True)
+    assert kinds(ev) == ['HourEvents'] * 2 + ['DayEvents'] + ['HourEvents'] * 2
+    ev = bitmapist.RangeEvents(
+        'active', datetime(2018, 3, 3, 10), datetime(2018, 3, 3, 12),
+        hourly=True)
+    assert [p.hour for p in ev.parts] == [10, 11, 12]
+
+
+@pytest.mark.parametrize('start, end', [
+    (date(2017, 12, 20), date(2018, 3, 10)),
+    (date(2018, 1, 1), date(2018, 1, 31)),
+    (date(2018, 2, 26), date(2018, 3, 4)),
+    (date(2018, 1, 29), date(2018, 3, 4)),
+    (date(2018, 3, 15), date(2018, 3, 15)),
+])
+def test_range_members(bitmapist, start, end):
+    day = start - timedelta(days=3)
+    uuid = 0
+    while day <= end + timedelta(days=3):
+        bitmapist.mark_event(
+            'active', uuid, timestamp=datetime(day.year, day.month, day.day))
+        day += timedelta(days=1)
+        uuid += 1
+    ev = bitmapist.RangeEvents('active', start, end)
+    assert list(ev) == list(range(3, 3 + (end - start).days + 1))
+
+
+def test_range_members_hourly(bitmapist):
+    start = datetime(2018, 3, 3, 20)
+    for hour in range(60):
+        bitmapist.mark_event(
+            'active', hour, timestamp=start + timedelta(hours=hour))
+    ev = bitmapist.RangeEvents(
+        'active', start + timedelta(hours=2), start + timedelta(hours=40),
+        hourly=True)
+    assert list(ev) == list(range(2, 41))
+
+
+def test_range_delta_and_period(bitmapist):
+    ev = bitmapist.RangeEvents('active', date(2018, 3, 3), date(2018, 3, 9))
+    assert ev.period_start() == datetime(2018, 3, 3)
+    assert ev.period_end() == datetime(2018, 3, 9, 23, 59, 59, 999999)
+    prev = ev.prev()
+    assert prev.period_start() == datetime(2018, 2, 24)
+    assert prev.period_end() == datetime(2018, 3, 2, 23, 59, 59, 999999)
+    assert ev.delta(2).period_start() == datetime(2018, 3, 17)
+    assert ev.event_finished()
+
+
+def test_range_operators(bitmapist):
+    bitmapist.mark_event('active', 1, timestamp=datetime(2018, 3, 5))
+    bitmapist.mark_event('active', 1, timestamp=datetime(2018, 3, 12))
+    bitmapist.mark_event('active', 2, timestamp=datetime(2018, 3, 12))
+    ev = bitmapist.RangeEvents('active', date(2018, 3, 10), date(2018, 3, 16))
+    assert list(ev & ev.prev()) == [1]
+    assert list(ev | ev.prev()) == [1, 2]
+    assert len(ev) == 2
+
+
+def test_range_invalid(bitmapist):
+    with pytest.raises(ValueError):
+        bitmapist.RangeEvents('active', date(2018, 3, 10), date(2018, 3, 9))
@@ -0,0 +1,115 @@
+from datetime import datetime
+
+import pytest
+
+
+def test_quarter_events(bitmapist):
+    bitmapist.mark_event('active', 1, timestamp=datetime(2017, 2, 10))
+    bitmapist.mark_event('active', 2, timestamp=datetime(2017, 3, 31))
+    bitmapist.mark_event('active', 3, timestamp=datetime(2017, 4, 1))
+    q1 = bitmapist.QuarterEvents('active', 2017, 1)
+    assert list(q1) == [1, 2]
+    assert list(q1.next()) == [3]
+    assert q1.period_start() == datetime(2017, 1, 1)
+    assert q1.period_end() == datetime(2017, 3, 31, 23, 59, 59, 999999)
+    assert bitmapist.QuarterEvents.from_date('active',
+                                             datetime(2017, 5, 1)) == q1.next()
+
+
+def test_rollups_disabled(bitmapist):
+    bitmapist.mark_event('active', 1, timestamp=datetime(2017, 2, 10))
+    year = bitmapist.YearEvents('active', 2017)
+    assert len(year) == 1
+    assert bitmapist.connection.ttl(year.redis_key) > 0
+    with pytest.raises(RuntimeError):
+        bitmapist.backfill_rollups(datetime(2017, 1, 1))
+
+
+def test_rollup_is_permanent(bitmapist_rollups):
+    b = bitmapist_rollups
+    b.mark_event('active', 1, timestamp=datetime(2017, 2, 10))
+    b.mark_event('active', 2, timestamp=datetime(2017, 11, 10))
+    year = b.YearEvents('active', 2017)
+    assert year.redis_key == 'bitmapist_active_Y2017'
+    assert list(year) == [1, 2]
+    assert b.connection.ttl(year.redis_key) == -1
+
+    b.bitop_cache_stats = {'hits': 0, 'misses': 0}
+    assert len(b.YearEvents('active', 2017)) == 2
+    assert b.bitop_cache_stats == {'hits': 1, 'misses': 0}
+
+
+def test_rollup_of_current_period(bitmapist_rollups):
+    b = bitmapist_rollups
+    b.mark_event('active', 1)
+    year = b.YearEvents('active')
+    assert year.redis_key.startswith('bitmapist_bitop_')
+    assert list(year) == [1]
+
+
+def test_rollup_nested(bitmapist_rollups):
+    b = bitmapist_rollups
+    b.mark_event('active', 1, timestamp=datetime(2016, 2, 10))
+    b.mark_event('active', 1, timestamp=datetime(2017, 2, 10))
+    b.mark_event('active', 2, timestamp=datetime(2017, 5, 10))
+    both = b.YearEvents('active', 2016) & b.YearEvents('active', 2017)
+    assert list(both) == [1]
+    assert b.connection.exists('bitmapist_active_Y2016')
+    assert b.connection.exists('bitmapist_active_Y2017')
+
+
+def test_late_mark_invalidates_rollups(bitmapist_rollups):
+    b = bitmapist_rollups
+    b.mark_event('active', 1, timestamp=datetime(2017, 2, 10))
+    assert list(b.YearEvents('active', 2017)) == [1]
+    assert list(b.QuarterEvents('active', 2017, 1)) == [1]
+
+    b.mark_event('active', 2, timestamp=datetime(2017, 3, 10))
+    assert not b.connection.exists('bitmapist_active_Y2017')
+    assert not b.connection.exists('bitmapist_active_Q2017-1')
+    assert list(b.YearEvents('active', 2017)) == [1, 2]
+    assert list(b.QuarterEvents('active', 2017, 1)) == [1, 2]
+
+    b.mark_events([('active', 3, datetime(2017, 8, 1))])
+    assert not b.connection.exists('bitmapist_active_Y2017')
+    assert b.connection.exists('bitmapist_active_Q2017-1')
+    assert list(b.YearEvents('active', 2017)) == [1, 2, 3]
+
+
+def test_stale_rollup_keys(bitmapist_rollups):
+    b = bitmapist_rollups
+    now = datetime(2018, 5, 10)
+    late = datetime(2017, 11, 10)
+    expected = (b.YearEvents('active', 2017).redis_key,
+                b.QuarterEvents('active', 2017, 4).redis_key)
+    assert b._stale_rollup_keys('active', late, now) == expected
+    # memoized
+    assert b._stale_rollup_keys('active', late, now) == expected
+    assert b._stale_rollup_keys('active', datetime(2018, 2, 1), now) == (
+        b.QuarterEvents('active', 2018, 1).redis_key, )
+    assert b._stale_rollup_keys('active', datetime(2018, 4, 1), now) == ()
+
+
+def test_backfill_rollups(bitmapist_rollups):
+    b = bitmapist_rollups
+    for month in (2, 5, 8, 11):
+        b.mark_event('active', 1, timestamp=datetime(2017, month, 10))
+        b.mark_event('signup', 1, timestamp=datetime(2017, month, 10))
+    start, end = datetime(2017, 1, 1), datetime(2017, 12, 31)
+    # 4 quarters and a year for each event
+    assert b.backfill_rollups(start, end) == 10
+    assert b.connection.exists('bitmapist_active_Q2017-1')
+    assert b.backfill_rollups(start, end) == 0
+    # empty rollups aren't stored
+    assert b.backfill_rollups(start, end, event_names=['foo']) == 5
+    assert not b.connection.exists('bitmapist_foo_Y2017')
+
+
+def test_backfill_command(bitmapist_rollups, redis_server, capsys):
+    from bitmapist4.rollups import main
+    b = bitmapist_rollups
+    b.mark_event('active', 1, timestamp=datetime(2017, 2, 10))
+    main(['--url', 'redis://%s:%s' % redis_server, '--start', '2017-01-01',
+          '--end', '2017-03-31'])
+    assert capsys.readouterr().out == 'Computed 2 rollups\n'
+    assert b.connection.exists('bitmapist_active_Q2017-1')
@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.mark.parametrize('timestamp', [
+    datetime(2014, 1, 1, 0, 30),
+    datetime(2015, 12, 31, 23, 59),
+    datetime(2016, 1, 3, 12),
+    datetime(2016, 2, 29, 5),
+    datetime(2018, 12, 31, 1),
+    datetime(2020, 12, 31, 22),
+    datetime(2021, 1, 1, 13),
+])
+def test_script_keys(bitmapist, bitmapist_scripting, timestamp):
+    bitmapist_scripting.mark_event('active', 1, timestamp=timestamp)
+    keys = bitmapist.connection.keys('bitmapist_active_*')
+    expected = bitmapist._mark_keys('active', timestamp, True, True)
+    assert sorted(k.decode() for k in keys) == sorted(expected)
+
+
+def test_script_mark_unmark(bitmapist_scripting):
+    b = bitmapist_scripting
+    b.mark_event('active', 10)
+    b.mark_event('active', 11, track_hourly=False, track_unique=False)
+    assert list(b.DayEvents('active')) == [10, 11]
+    assert list(b.HourEvents('active')) == [10]
+    assert list(b.UniqueEvents('active')) == [10]
+
+    b.unmark_event('active', 10)
+    assert list(b.DayEvents('active')) == [11]
+
+
+def test_script_transaction(bitmapist_scripting):
+    b = bitmapist_scripting
+    with b.transaction():
+        b.mark_event('active', 1)
+        b.mark_event('active', 2, timestamp=datetime.utcnow() -
+                     timedelta(days=1))
+    assert list(b.DayEvents('active')) == [1]
+    assert list(b.WeekEvents('active').delta(-1) | b.WeekEvents('active')) \
+        == [1, 2]
+
+
+def test_script_event_index(bitmapist_scripting):
+    bitmapist_scripting.mark_event('active', 1)
+    assert bitmapist_scripting.connection.zrange(
+        'bitmapist_meta_events', 0, -1) == [b'active']
+
+
+def test_script_mark_round_trips(bitmapist_scripting):
+    b = bitmapist_scripting
+    b.use_rollups = True
+    b.mark_event('warmup', 1, timestamp=datetime(2018, 1, 1))
+    commands = []
+    execute_command = b.connection.execute_command
+
+    def record(*args, **kwargs):
+        commands.append(args[0])
+        return execute_command(*args, **kwargs)
+
+    b.connection.execute_command = record
+    # indexing the event, invalidating cached counts and rollups go with
+    # the mark
+    b.mark_event('active', 1, timestamp=datetime(2018, 1, 1))
+    assert commands == []
+    b.mark_event('active', 1)
+    assert commands == ['EVALSHA']
+    assert b.get_event_names() == ['active', 'warmup']
@@ -0,0 +1,118 @@
+import atexit
+import threading
+import time
+
+import pytest
+
+
+def test_buffered_marks(bitmapist):
+    bitmapist.start_buffering(batch_size=10, flush_interval=60)
+    for uuid in range(25):
+        bitmapist.mark_event('active', uuid)
+    bitmapist.unmark_event('active', 0)
+    assert bitmapist.flush(timeout=5)
+    assert list(bitmapist.DayEvents('active')) == list(range(1, 25))
+    bitmapist.stop_buffering()
+
+
+def test_flush_on_stop(bitmapist):
+    bitmapist.start_buffering(flush_interval=60)
+    bitmapist.mark_event('active', 1)
+    bitmapist.stop_buffering()
+    assert list(bitmapist.DayEvents('active')) == [1]
+
+    bitmapist.mark_event('active', 2)
+    assert list(bitmapist.DayEvents('active')) == [1, 2]
+
+
+def test_flush_interval(bitmapist):
+    bitmapist.start_buffering(flush_interval=0.01)
+    bitmapist.mark_event('active', 1)
+    for _ in range(100):
+        if 1 in bitmapist.DayEvents('active'):
+            break
+        time.sleep(0.01)
+    assert 1 in bitmapist.DayEvents('active')
+    bitmapist.stop_buffering()
+
+
+def test_buffering_errors(bitmapist):
+    with pytest.raises(ValueError):
+        bitmapist.start_buffering(on_full='explode')
+    bitmapist.start_buffering()
+    with pytest.raises(RuntimeError):
+        bitmapist.start_buffering()
+    bitmapist.stop_buffering()
+    with pytest.raises(RuntimeError):
+        bitmapist.stop_buffering()
+
+
+def test_flush_timeout_on_full_queue(bitmapist):
+    bitmapist.start_buffering(batch_size=1, flush_interval=60,
+                              max_queue_size=1)
+    writer = bitmapist.writer
+    write = writer._write
+    started, release = threading.Event(), threading.Event()
+
+    def slow_write(items):
+        started.set()
+        release.wait(5)
+        write(items)
+
+    writer._write = slow_write
+    bitmapist.mark_event('active', 1)
+    assert started.wait(5)
+    bitmapist.mark_event('active', 2)  # fills the queue
+    begin = time.time()
+    assert not bitmapist.flush(timeout=0.1)
+    assert time.time() - begin < 1
+    release.set()
+    assert bitmapist.flush(timeout=5)
+    assert list(bitmapist.DayEvents('active')) == [1, 2]
+    bitmapist.stop_buffering()
+
+
+def test_exit_handler_is_removed(bitmapist, monkeypatch):
+    handlers = []
+    monkeypatch.setattr(atexit, 'register', handlers.append)
+    monkeypatch.setattr(atexit, 'unregister', handlers.remove)
+    bitmapist.start_buffering()
+    assert len(handlers) == 1
+    bitmapist.stop_buffering()
+    assert handlers == []
+
+
+def test_event_index_after_failed_write(bitmapist):
+    bitmapist.rebuild_event_index()
+    bitmapist.start_buffering(flush_interval=60)
+    writer = bitmapist.writer
+    write_pipeline = bitmapist.connection.pipeline
+
+    def broken_pipeline(*args, **kwargs):
+        pipe = write_pipeline(*args, **kwargs)
+        pipe.execute = lambda: 1 / 0
+        return pipe
+
+    bitmapist.connection.pipeline = broken_pipeline
+    bitmapist.mark_event('signup', 1)
+    assert bitmapist.flush(timeout=5)
+    assert writer.errors == 1
+    del bitmapist.connection.pipeline
+
+    bitmapist.mark_event('signup', 2)
+    bitmapist.stop_buffering()
+    assert bitmapist.get_event_names() == ['signup']
+
+
+def test_transaction_marks_are_not_buffered(bitmapist):
+    bitmapist.start_buffering(flush_interval=60)
+    with pytest.raises(ValueError):
+        with bitmapist.transaction():
+            bitmapist.mark_event('active', 1)
+            raise ValueError()
+    with bitmapist.transaction():
+        bitmapist.mark_event('active', 2)
+    # committed without flushing the buffer
+    assert list(bitmapist.DayEvents('active')) == [2]
+    bitmapist.stop_buffering()
+    assert list(bitmapist.DayEvents('active')) == [2]